@@ -1,7 +1,9 @@
+import copy
 import datetime
 import logging
 import random
 import math
+import struct
 import traceback
 
 from typing import Dict,List,Tuple
@@ -15,6 +17,8 @@ from hashlib import sha256
 from src.system.da_types import DistributedAlgorithm, message_wrapper
 from src.implementation.dolev_rc_new import BasicDolevRC, MessageConfig, DolevMessage
 from src.implementation.node_log import message_logger, OutputMetrics, LOG_LEVEL
+from src.implementation.retention import StateRetention
+from src.implementation.content_store import Content, ContentStore
 
 from src.implementation.dolev_rc_new import MessageType
 
@@ -25,6 +29,47 @@ class BrachaConfig(MessageConfig):
         self.Optim1 = True
         self.Optim2 = True
         self.Optim3 = False
+        self.content_digests = True # ECHO/READY carry the SHA-256 of the content instead of the content itself
+        self.vote_batch_window = 0.01 # seconds ECHO/READY votes are collected into one VOTES message, 0 disables it (needs content_digests)
+        self.content_retry_interval = 1.0 # seconds before an unanswered content request is sent again, doubled per retry
+        self.content_retries = 4 # times an unanswered content request is sent again before the fetch is given up
+
+VOTE_PHASES = (MessageType.ECHO, MessageType.READY)
+_VOTE_HEADER = struct.Struct(">BqB") # phase index in VOTE_PHASES, u_id, digest length
+
+def pack_votes(votes: List[Tuple[MessageType, int, bytes]]) -> bytes:
+    return b"".join(_VOTE_HEADER.pack(VOTE_PHASES.index(phase), u_id, len(digest)) + digest for phase, u_id, digest in votes)
+
+def unpack_votes(data: bytes) -> List[Tuple[MessageType, int, bytes]]:
+    '''
+        Raises ValueError when `data` is not a valid encoding, it comes from other (possibly Byzantine) nodes.
+    '''
+    votes = []
+    offset = 0
+    while offset < len(data):
+        if offset + _VOTE_HEADER.size > len(data):
+            raise ValueError("Truncated vote header")
+        phase, u_id, digest_len = _VOTE_HEADER.unpack_from(data, offset)
+        offset += _VOTE_HEADER.size
+        if phase >= len(VOTE_PHASES):
+            raise ValueError(f"Unknown vote phase {phase}")
+        if offset + digest_len > len(data):
+            raise ValueError("Truncated vote digest")
+        votes.append((VOTE_PHASES[phase], u_id, bytes(data[offset:offset + digest_len])))
+        offset += digest_len
+    return votes
+
+@dataclass(msg_id=4)
+class ContentRequest:
+    digest: bytes
+
+@dataclass(msg_id=5)
+class ContentResponse:
+    digest: bytes
+    message: str
+    vector_clock: bytes
+    causal_order_queue: List[int]
+    author_id: int
 
 class BrachaRB(BasicDolevRC):
     def __init__(self, settings: CommunitySettings, parameters=BrachaConfig()) -> None:
@@ -40,6 +85,9 @@ class BrachaRB(BasicDolevRC):
         self.is_ready_sent: dict[str, bool] = {}# message_id -> is READY message sent
 
         self.is_BRBdelivered: dict[str, bool] = {}  # message_id -> if this message has gone through SEND ECHO READY and can be BRB delivered
+        # per u_id, Dolev keeps its own per phase message. u_ids and message ids are disjoint (see generate_uid), so
+        # they can share the tombstones
+        self.brb_retention = StateRetention(parameters.retention_quiescence, tombstones=self.tombstones)
         
         self.Optim1 = parameters.Optim1
         self.Optim2 = parameters.Optim2
@@ -53,23 +101,29 @@ class BrachaRB(BasicDolevRC):
         self.gen_mal_threshold = 2 # use this so mal node doesnt fill the network with garbage msg
         self.gen_mal_msg_cnt = 0
 
+        self.content_digests = parameters.content_digests
+        self.content_store = ContentStore()
+        self.uid_digest: dict[int, bytes] = {}
+        self.awaiting_content: dict[bytes, List[DolevMessage]] = {} # digest -> READYs whose BRB delivery waits for a fetch
+        self.content_retry_interval = parameters.content_retry_interval
+        self.content_retries = parameters.content_retries
+        self.vote_batch_window = parameters.vote_batch_window if self.content_digests else 0
+        self.pending_votes: List[Tuple[MessageType, DolevMessage]] = []
+        self.add_message_handler(ContentRequest, self.on_content_request)
+        self.add_message_handler(ContentResponse, self.on_content_response)
+
     def gen_output_file_path(self, test_name: str = "Bracha_Test_mal"):
         return super().gen_output_file_path(test_name)
 
     
     def generate_message(self) -> DolevMessage:
         msg = "".join([random.choice(["uk", "pk", "mkk", "fk"]) for _ in range(6)])
-        u_id = self.get_uid_pred()
-        msg_id = self.generate_message_id(msg)
-        return DolevMessage(u_id, msg, msg_id, self.node_id, [], [], MessageType.BRACHA.value)
-    
-    def generate_message_id(self, msg: str) -> int:
-        msg = random.shuffle(list(msg)) # randomize it so we create unique id
-        self.message_broadcast_cnt += 1
-        return self.node_id * 169 + self.message_broadcast_cnt * 13 + (hash(msg) % 997)
+        u_id = self.get_uid_pred(msg)
+        # only the phase messages are Dolev-broadcast, the Bracha message itself needs no id of its own
+        return DolevMessage(u_id, msg, u_id, self.node_id, [], b"", [], MessageType.BRACHA.value)
     
     def generate_malicious_message_id(self, msg: str) -> int:
-        return self.node_id * 169 + (hash(msg) % 997)
+        return self.generate_message_id(msg)
     
     def generate_phase_msg(self, og_msg, msg_type) :
         u_id, message, source_id, destination = og_msg.u_id, og_msg.message, self.node_id, []
@@ -77,19 +131,34 @@ class BrachaRB(BasicDolevRC):
         author_id = og_msg.author_id
         queue = og_msg.causal_order_queue
 
-        phase_msg_id = self.generate_message_id(message)
+        digest = b""
+        if self.content_digests:
+            digest = self.remember_content(og_msg)
+            if msg_type != MessageType.SEND:
+                message, vc, queue = "", b"", []
+
+        # no id is spent on a phase message Optim3 suppresses, see generate_message_id
+        if (msg_type == MessageType.ECHO and not self.is_Optim3_ECHO()) or \
+                (msg_type == MessageType.READY and not self.is_Optim3_READY()):
+            return None
+        if msg_type == MessageType.SEND and self.Optim2: # only reaches the neighbours, see generate_uid
+            phase_msg_id = self.generate_uid(message)
+        else:
+            phase_msg_id = self.generate_message_id(message)
+
         if msg_type == MessageType.SEND:
             if self.Optim2:
-                return DolevMessage(u_id, message, phase_msg_id, source_id, destination, vc,queue, msg_type.value, False, author_id)
+                return DolevMessage(u_id, message, phase_msg_id, source_id, destination, vc,queue, msg_type.value, False, author_id, digest=digest)
             else:
-                return DolevMessage(u_id, message, phase_msg_id, source_id, destination, vc, queue, msg_type.value, True, author_id)
+                return DolevMessage(u_id, message, phase_msg_id, source_id, destination, vc, queue, msg_type.value, True, author_id, digest=digest)
         elif msg_type == MessageType.ECHO and self.is_Optim3_ECHO():
-            return DolevMessage(u_id,message, phase_msg_id, source_id, destination, vc, queue , msg_type.value, True, author_id)
+            return DolevMessage(u_id,message, phase_msg_id, source_id, destination, vc, queue , msg_type.value, True, author_id, digest=digest)
         elif msg_type == MessageType.READY and self.is_Optim3_READY():
-            return DolevMessage(u_id, message, phase_msg_id, source_id, destination, vc, queue, msg_type.value, True, author_id)
+            return DolevMessage(u_id, message, phase_msg_id, source_id, destination, vc, queue, msg_type.value, True, author_id, digest=digest)
         
-    def get_uid_pred(self):
-        return hash(datetime.datetime.now()) % 9997
+    def get_uid_pred(self, msg: str = "") -> int:
+        # u_ids have a counter of their own, see generate_uid
+        return self.generate_uid(msg)
         
         
     async def on_start(self):
@@ -111,7 +180,7 @@ class BrachaRB(BasicDolevRC):
         # ⟨Dolev,Broadcast|[Send,m]⟩
         
         #log the bracha msg at first
-        self.msg_log.log(LOG_LEVEL.DEBUG, f"log the bracha msg at first {message.u_id}")
+        self.msg_log.log(LOG_LEVEL.DEBUG, "log the bracha msg at first %s", message.u_id)
         self.msg_log.get_deliver_info_msg(message.u_id)
         self.msg_log.set_metric_start_time(message.u_id)
 
@@ -120,7 +189,9 @@ class BrachaRB(BasicDolevRC):
     
     #event ⟨al,Deliver | p,[SEND,m]⟩
     async def on_send(self, payload: DolevMessage):
-        self.msg_log.log(LOG_LEVEL.DEBUG, f"Received a SEND message: {payload.message_id}.")
+        self.msg_log.log(LOG_LEVEL.DEBUG, "Received a SEND message: %s.", payload.message_id)
+        if self.content_digests:
+            self.remember_content(payload)
         # upon event ⟨al,Deliver | p,[SEND,m]⟩ and not sentEcho do
         # threshold = math.ceil((self.f + self.N + 1) / 2)
         # await self.trigger_send_echo(message_id, self.echo_count[message_id], threshold, payload)
@@ -128,45 +199,55 @@ class BrachaRB(BasicDolevRC):
 
     # upon event ⟨al,Deliver | p,[ECHO,m]⟩ do
     async def on_echo(self, payload: DolevMessage):
-        self.msg_log.log(LOG_LEVEL.DEBUG, f"Received an ECHO message: {payload.message_id}.")
+        self.msg_log.log(LOG_LEVEL.DEBUG, "Received an ECHO message: %s.", payload.message_id)
         
         # echos.insert(p)
         self.increment_echo_count(payload.u_id, payload.source_id)
         # upon event echos.size() ≥ ⌈N+f+1⌉ and not sentReady do
         threshold = math.ceil((self.f + self.N + 1) / 2)
-        self.msg_log.log(LOG_LEVEL.DEBUG, f"echo nodes: {list(self.echo_count.values())}")
+        self.msg_log.log(LOG_LEVEL.DEBUG, "echo nodes: %s", list(self.echo_count.values()))
         await self.trigger_send_ready(len(list(self.echo_count.get(payload.u_id))), threshold, payload)
         await self.Optim1_handler(payload.u_id, payload, MessageType.ECHO)
 
 
     # upon event ⟨al,Deliver | p,[READY,m]⟩ do
     async def on_ready(self, payload: DolevMessage):
-        self.msg_log.log(LOG_LEVEL.DEBUG, f"Received a READY message: {payload.message_id}. uid={payload.u_id}")
+        self.msg_log.log(LOG_LEVEL.DEBUG, "Received a READY message: %s. uid=%s", payload.message_id, payload.u_id)
 
         self.increment_ready_count(payload.u_id, payload.source_id)
         # upon event readys.size() ≥ f+1 and not sentReady do
         threshold = self.f + 1
-        self.msg_log.log(LOG_LEVEL.DEBUG, f"ready nodes: {self.ready_count}")
+        self.msg_log.log(LOG_LEVEL.DEBUG, "ready nodes: %s", self.ready_count)
         await self.trigger_send_ready(len(list(self.ready_count.get(payload.u_id))), threshold, payload)
 
         # upon event readys.size() ≥ 2f+1 and not delivered do
         delivered_threshold = (len(self.ready_count.get(payload.u_id)) >= 2*self.f+1) \
                                 and not self.is_BRBdelivered.get(payload.u_id)
 
-        self.msg_log.log(LOG_LEVEL.DEBUG, f"threshold: {self.is_BRBdelivered.get(payload.u_id)}")
-        self.msg_log.log(LOG_LEVEL.DEBUG, f"Deliver_threshold: {delivered_threshold}, {len(self.ready_count.get(payload.u_id))}")
+        self.msg_log.log(LOG_LEVEL.DEBUG, "threshold: %s", self.is_BRBdelivered.get(payload.u_id))
+        self.msg_log.log(LOG_LEVEL.DEBUG, "Deliver_threshold: %s, %s", delivered_threshold, len(self.ready_count.get(payload.u_id)))
         if delivered_threshold:
-            self.msg_log.log(LOG_LEVEL.DEBUG, f"Node {self.node_id} trying to trigger bracha Delivery, but where am I going?")
-            self.trigger_Bracha_Delivery(payload)
+            self.msg_log.log(LOG_LEVEL.DEBUG, "Node %s trying to trigger bracha Delivery, but where am I going?", self.node_id)
+            full_payload = self.with_content(payload)
+            if full_payload is None:
+                self.fetch_content(payload)
+            else:
+                self.trigger_Bracha_Delivery(full_payload)
         
         await self.Optim1_handler(payload.u_id, payload, MessageType.ECHO)
 
     #  ⟨Dolev,Broadcast|[mType,m]⟩ ensure each msg is broadcasted to all node through dolev protocol
     async def broadcast_message(self, msg_type: MessageType, payload: DolevMessage):
 
+        if self.vote_batch_window and msg_type in VOTE_PHASES:
+            self.queue_vote(msg_type, payload)
+            return
+
         new_msg = self.generate_phase_msg(payload, msg_type)
+        if new_msg is None: # suppressed by Optim3
+            return
 
-        self.msg_log.log(LOG_LEVEL.DEBUG, f"Sent {new_msg.phase} messages: {new_msg.message_id}")
+        self.msg_log.log(LOG_LEVEL.DEBUG, "Sent %s messages: %s", new_msg.phase, new_msg.message_id)
         await super().on_broadcast(new_msg)
 
             
@@ -194,7 +275,7 @@ class BrachaRB(BasicDolevRC):
         """
         sent_ready = self.check_if_ready_sent(u_id)
         
-        self.msg_log.log(LOG_LEVEL.DEBUG, f"is_ready_sent: {sent_ready}, trigger_send_ready: {count} >= {threshold}???")
+        self.msg_log.log(LOG_LEVEL.DEBUG, "is_ready_sent: %s, trigger_send_ready: %s >= %s???", sent_ready, count, threshold)
 
         if not sent_ready and count >= threshold:
             self.set_ready_sent_true(u_id)
@@ -206,6 +287,27 @@ class BrachaRB(BasicDolevRC):
         #self.msg_log.log(LOG_LEVEL.DEBUG, "About to call super().trigger_delivery")
         await super().trigger_delivery(payload)
 
+        if payload.phase == MessageType.VOTES.value:
+            try:
+                votes = unpack_votes(payload.votes)
+            except ValueError as e:
+                self.msg_log.log(LOG_LEVEL.WARNING, "Node %s dropped malformed VOTES message %s from %s: %s",
+                                 self.node_id, payload.message_id, payload.source_id, e)
+                return
+            # every vote is accounted for as if it came in its own ECHO/READY message
+            for phase, u_id, digest in votes:
+                vote = copy.copy(payload)
+                vote.u_id, vote.phase, vote.digest, vote.votes = u_id, phase.value, digest, b""
+                await self.deliver_phase_msg(vote)
+        else:
+            await self.deliver_phase_msg(payload)
+
+    async def deliver_phase_msg(self, payload: DolevMessage):
+        if self.brb_retention.is_retired(payload.u_id):
+            self.msg_log.log(LOG_LEVEL.DEBUG, "Late %s message for retired u_id %s, discarded", payload.phase, payload.u_id)
+            return
+        self.brb_retention.touch(payload.u_id)
+
         payload_type = payload.phase
         if MessageType[payload_type] == MessageType.SEND : 
             await self.on_send(payload)
@@ -221,12 +323,15 @@ class BrachaRB(BasicDolevRC):
         try:
             u_id = payload.u_id # original id to identify the message we want to deliver
             self.is_BRBdelivered.update({u_id: True})
-            self.msg_log.log(LOG_LEVEL.DEBUG, f"Node {self.node_id} BRB Delivered a message: {payload.u_id}, content: {payload.message}")
+            if self.awaiting_content:
+                self.forget_awaiting(u_id)
+            self.msg_log.log(LOG_LEVEL.DEBUG, "Node %s BRB Delivered a message: %s, content: %s", self.node_id, payload.u_id, payload.message)
 
             self.write_bracha_msg_metric(u_id)
             
-            for u_id, status in self.is_BRBdelivered.items():
-                self.msg_log.log(LOG_LEVEL.DEBUG, f"BRB Delivered Messages: Message ID: {u_id}, Delivered: {status}")
+            if self.msg_log.is_enabled(LOG_LEVEL.DEBUG):
+                for u_id, status in self.is_BRBdelivered.items():
+                    self.msg_log.log(LOG_LEVEL.DEBUG, "BRB Delivered Messages: Message ID: %s, Delivered: %s", u_id, status)
 
             self.msg_log.flush()
 
@@ -242,11 +347,11 @@ class BrachaRB(BasicDolevRC):
     # return DolevMessage(u_id, msg, msg_id, self.node_id, [], "BRACHA")
     def generate_malicious_msg(self) -> DolevMessage:
         msg = f"fake news!"
-        u_id = hash(msg)
+        u_id = self.get_uid_pred(msg)
         msg_id = self.generate_message_id(msg)
 
-        mal_msg = DolevMessage(u_id, msg, msg_id, self.node_id, [], [], MessageType.BRACHA.value)
-        self.msg_log.log(LOG_LEVEL.DEBUG, f"[Malicious Node {self.node_id}] generated malicious msg {mal_msg} to send")
+        mal_msg = DolevMessage(u_id, msg, msg_id, self.node_id, [], b"", [], MessageType.BRACHA.value)
+        self.msg_log.log(LOG_LEVEL.DEBUG, "[Malicious Node %s] generated malicious msg %s to send", self.node_id, mal_msg)
         return mal_msg
     
     def mal_modify_msg(self, payload: DolevMessage) ->  DolevMessage:
@@ -268,13 +373,13 @@ class BrachaRB(BasicDolevRC):
             if random.randrange(100) < 40 and self.gen_mal_msg_cnt < self.gen_mal_threshold:
                 new_type = random.choice([MessageType.ECHO, MessageType.READY])
                 new_message = 'faked: ' + payload.message
-                new_uid = hash(random.shuffle(list(new_message)))  #This uid should be randomized since it doesnt even matter
+                new_uid = self.get_uid_pred(new_message)  # a fresh u_id, it does not matter which
                 new_message_id = self.generate_message_id(new_message)
-                fake_msg = DolevMessage(new_uid, new_message, new_message_id, self.node_id, [], new_type)
+                fake_msg = DolevMessage(new_uid, new_message, new_message_id, self.node_id, [], b"", [], new_type.value)
 
                 self.gen_mal_msg_cnt+=1
 
-                self.msg_log.log(LOG_LEVEL.INFO, f"Malicious Node {self.node_id} Generated a fake {new_type.value} Message.")
+                self.msg_log.log(LOG_LEVEL.INFO, "Malicious Node %s Generated a fake %s Message.", self.node_id, new_type.value)
                 self.msg_log.log(LOG_LEVEL.DEBUG, fake_msg)
                 return fake_msg,True
             else:
@@ -309,7 +414,7 @@ class BrachaRB(BasicDolevRC):
                     count = len(list(self.echo_count.get(uuid,[])))
                     threshold = self.f + 1
                     if count >= threshold :
-                        self.msg_log.log(LOG_LEVEL.DEBUG,f"OPT1 Triggered")
+                        self.msg_log.log(LOG_LEVEL.DEBUG, "OPT1 Triggered")
                         await self.trigger_send_echo(payload)
                             
                 elif msg_type == MessageType.READY:
@@ -339,6 +444,170 @@ class BrachaRB(BasicDolevRC):
         if self.Optim3:
             return self.node_id < self.Optim3_READY
 
+    """
+    Vote batching
+    """
+    def queue_vote(self, msg_type: MessageType, payload: DolevMessage):
+        allowed = self.is_Optim3_ECHO() if msg_type == MessageType.ECHO else self.is_Optim3_READY()
+        if not allowed:
+            return
+        self.remember_content(payload)
+        if not self.pending_votes:
+            self.register_anonymous_task("flush_votes", self.flush_votes, delay=self.vote_batch_window)
+        self.pending_votes.append((msg_type, payload))
+
+    async def flush_votes(self):
+        '''
+            Broadcast the votes collected during the batching window: one Dolev broadcast for all of them.
+        '''
+        votes, self.pending_votes = self.pending_votes, []
+        if not votes:
+            return
+        if len(votes) == 1:
+            msg_type, payload = votes[0]
+            new_msg = self.generate_phase_msg(payload, msg_type)
+        else:
+            packed = pack_votes([(msg_type, payload.u_id, self.remember_content(payload)) for msg_type, payload in votes])
+            batch_id = self.generate_message_id(packed.hex())
+            new_msg = DolevMessage(batch_id, "", batch_id, self.node_id, [], b"", [], MessageType.VOTES.value, True,
+                                   votes=packed)
+
+        self.msg_log.log(LOG_LEVEL.DEBUG, "Sent %s messages: %s with %s votes", new_msg.phase, new_msg.message_id, len(votes))
+        await super().on_broadcast(new_msg)
+
+    """
+    Content by digest
+    """
+    def is_reference(self, payload: DolevMessage) -> bool:
+        return bool(payload.digest) and payload.phase in (MessageType.ECHO.value, MessageType.READY.value)
+
+    def remember_content(self, payload: DolevMessage) -> bytes:
+        '''
+            Digest of the content `payload` carries or refers to. Carried content is stored, and handed to whoever
+            was waiting for it.
+        '''
+        if self.is_reference(payload):
+            self.uid_digest.setdefault(payload.u_id, payload.digest)
+            return payload.digest
+        # bytes(): a received vector clock is a view into the packet, which the store should not keep alive
+        digest = self.content_store.put(Content(payload.message, bytes(payload.vector_clock),
+                                                list(payload.causal_order_queue), payload.author_id))
+        self.uid_digest.setdefault(payload.u_id, digest)
+        self.content_arrived(digest)
+        return digest
+
+    def with_content(self, payload: DolevMessage):
+        '''
+            `payload` with the content filled in from the store, None if the content has not been seen yet.
+        '''
+        if not self.is_reference(payload):
+            return payload
+        content = self.content_store.get(payload.digest)
+        if content is None:
+            return None
+        full_payload = copy.copy(payload)
+        full_payload.message, full_payload.vector_clock, full_payload.causal_order_queue, full_payload.author_id = content
+        return full_payload
+
+    def fetch_content(self, payload: DolevMessage):
+        digest = payload.digest
+        self.awaiting_content.setdefault(digest, []).append(payload)
+        if digest in self.content_store.requested:
+            return
+        self.msg_log.log(LOG_LEVEL.DEBUG, "Node %s fetching the content of u_id %s", self.node_id, payload.u_id)
+        self.request_content(digest, [peer for _, peer in self.neighbours()])
+
+    def request_content(self, digest: bytes, peers, attempt: int = 0):
+        self.content_store.requested.add(digest)
+        self.multicast(peers, ContentRequest(digest))
+        # the request or its response can get lost, so `requested` must not block the digest for good
+        self.register_anonymous_task("content_retry", self.retry_content, digest, attempt,
+                                     delay=self.content_retry_interval * 2 ** attempt)
+
+    def retry_content(self, digest: bytes, attempt: int):
+        if digest in self.content_store or digest not in self.content_store.requested:
+            return
+        self.content_store.requested.discard(digest)
+
+        # only READYs of u_ids that still wait for their BRB delivery keep the fetch alive
+        pending = [payload for payload in self.awaiting_content.pop(digest, ())
+                   if not self.is_BRBdelivered.get(payload.u_id) and not self.brb_retention.is_retired(payload.u_id)]
+        if pending:
+            self.awaiting_content[digest] = pending
+            if attempt < self.content_retries:
+                self.msg_log.log(LOG_LEVEL.DEBUG, "Node %s asking again for the content of digest %s", self.node_id, digest.hex())
+                self.request_content(digest, [peer for _, peer in self.neighbours()], attempt + 1)
+                return
+            # e.g. a digest no correct node has, from a Byzantine READY. The READYs stay until their u_id is delivered
+            # or retired: content that still shows up, or a later READY that fetches again, can deliver them.
+            self.msg_log.log(LOG_LEVEL.WARNING, "Node %s gave up fetching the content of digest %s", self.node_id, digest.hex())
+        self.content_store.pop_waiters(digest) # the peers that asked this node retry on their own
+
+    def forget_awaiting(self, u_id):
+        for digest, pending in list(self.awaiting_content.items()):
+            pending = [payload for payload in pending if payload.u_id != u_id]
+            if pending:
+                self.awaiting_content[digest] = pending
+            else:
+                del self.awaiting_content[digest]
+
+    def content_arrived(self, digest: bytes):
+        content = self.content_store.get(digest)
+        for peer in self.content_store.pop_waiters(digest):
+            self.ez_send(peer, ContentResponse(digest, *content))
+
+        for pending in self.awaiting_content.pop(digest, ()):
+            if not self.is_BRBdelivered.get(pending.u_id):
+                self.trigger_Bracha_Delivery(self.with_content(pending))
+
+    @message_wrapper(ContentRequest)
+    def on_content_request(self, peer: Peer, payload: ContentRequest):
+        content = self.content_store.get(payload.digest)
+        if content is not None:
+            self.ez_send(peer, ContentResponse(payload.digest, *content))
+            return
+        # Not here either: ask our own neighbours (once per digest) and answer when it arrives
+        self.content_store.add_waiter(payload.digest, peer)
+        if payload.digest not in self.content_store.requested:
+            self.request_content(payload.digest, [neighbour for _, neighbour in self.neighbours() if neighbour is not peer])
+
+    @message_wrapper(ContentResponse)
+    def on_content_response(self, peer: Peer, payload: ContentResponse):
+        if payload.digest in self.content_store:
+            return
+        content = Content(payload.message, payload.vector_clock, payload.causal_order_queue, payload.author_id)
+        if self.content_store.put(content, payload.digest) is None:
+            self.msg_log.log(LOG_LEVEL.WARNING, "Node %s got content that does not match its digest, discarded", self.node_id)
+            return
+        self.content_arrived(payload.digest)
+
+    """
+    Retention
+    """
+    def collect_garbage(self):
+        super().collect_garbage()
+        for u_id in self.brb_retention.collect(self.is_brb_done):
+            self.retire_brb_message(u_id)
+
+    def is_brb_done(self, u_id) -> bool:
+        return self.is_BRBdelivered.get(u_id, False) and self.is_ready_sent.get(u_id, False)
+
+    def retire_brb_message(self, u_id):
+        for state in (self.echo_count, self.is_echo_sent, self.ready_count, self.is_ready_sent, self.is_BRBdelivered):
+            state.pop(u_id, None)
+        digest = self.uid_digest.pop(u_id, None)
+        if digest is not None:
+            self.content_store.discard(digest)
+        self.forget_awaiting(u_id)
+        self.msg_log.forget_metrics(u_id, *self.msg_log.log_metrics.phase_msg_ids.get(u_id, ()))
+
+    def forget_message_metrics(self, message_id):
+        # phase message metrics are summed into their u_id at BRB delivery and dropped together with it, only a
+        # VOTES batch, which is its own u_id and has no BRB state, is dropped here
+        info = self.msg_log.log_metrics.delivered_info.get(message_id)
+        if info is not None and info.u_id == message_id:
+            self.msg_log.forget_metrics(message_id)
+
     """
     Getter & Setter
     """
@@ -375,5 +644,5 @@ class BrachaRB(BasicDolevRC):
     
     def write_bracha_msg_metric(self,u_id):
         self.log_delivered_status(u_id, True)
-        self.set_metric_end_time(u_id)
+        self.set_metric_end_time(u_id, "brb")
         self.msg_log.log_msg_summary(u_id, MessageType.BRACHA)
\ No newline at end of file
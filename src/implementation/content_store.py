@@ -0,0 +1,73 @@
+import struct
+
+from hashlib import sha256
+from typing import Dict, List, NamedTuple, Optional, Set
+
+
+class Content(NamedTuple):
+    """
+    The part of a Bracha broadcast that ECHO and READY only refer to by digest.
+    """
+    message: str
+    vector_clock: bytes
+    causal_order_queue: List[int]
+    author_id: int
+
+
+def content_digest(content: Content) -> bytes:
+    """
+    SHA-256 over a length-prefixed encoding of the content, so that no two different contents share an input.
+    """
+    h = sha256()
+    message = content.message.encode()
+    h.update(struct.pack(">qI", content.author_id, len(message)))
+    h.update(message)
+    h.update(struct.pack(">I", len(content.vector_clock)))
+    h.update(content.vector_clock)
+    h.update(struct.pack(f">I{len(content.causal_order_queue)}q", len(content.causal_order_queue),
+                         *content.causal_order_queue))
+    return h.digest()
+
+
+class ContentStore:
+    """
+    Contents by digest, plus the bookkeeping of on-demand fetches: the digests this node has an outstanding request
+    for (cleared again when the request times out) and, per digest, the peers that asked this node and are still
+    waiting for an answer.
+    """
+
+    def __init__(self):
+        self.contents: Dict[bytes, Content] = {}
+        self.requested: Set[bytes] = set()
+        self.waiters: Dict[bytes, Set] = {}
+
+    def put(self, content: Content, digest: Optional[bytes] = None) -> Optional[bytes]:
+        """
+        Store `content` and return its digest. When `digest` is given the content has to match it, None otherwise.
+        """
+        actual = content_digest(content)
+        if digest is not None and digest != actual:
+            return None
+        self.contents[actual] = content
+        self.requested.discard(actual)
+        return actual
+
+    def get(self, digest: bytes) -> Optional[Content]:
+        return self.contents.get(digest)
+
+    def __contains__(self, digest: bytes) -> bool:
+        return digest in self.contents
+
+    def add_waiter(self, digest: bytes, peer) -> None:
+        self.waiters.setdefault(digest, set()).add(peer)
+
+    def pop_waiters(self, digest: bytes) -> Set:
+        return self.waiters.pop(digest, set())
+
+    def discard(self, digest: bytes) -> None:
+        self.contents.pop(digest, None)
+        self.requested.discard(digest)
+        self.waiters.pop(digest, None)
+
+    def __len__(self):
+        return len(self.contents)
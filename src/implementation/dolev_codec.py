@@ -0,0 +1,162 @@
+"""
+Binary layout of DolevMessage (version 1).
+
+    version        byte
+    phase          byte, index in PHASES (255: the phase string follows, length-prefixed)
+    flags          byte, bit 0: is_delayed
+    message_id     varint (zigzag)
+    source_id      varint (zigzag)
+    path           varint count + varint hops
+    path_mask      varint length + bytes
+    packed_path    varint length + bytes
+    u_id           varint (zigzag)
+    author_id      varint (zigzag)
+    message        varint length + utf-8
+    vector_clock   varint length + bytes
+    causal queue   varint count + varints (zigzag)
+    digest         varint length + bytes
+    votes          varint length + bytes
+
+The fields needed to route and discard a message come first, so they can be read without decoding the rest (see
+`read_header`). Decoding walks a memoryview of the packet; vector_clock and votes stay views into it instead of
+being copied.
+"""
+from typing import List, NamedTuple, Tuple
+
+VERSION = 1
+PHASES = ("None", "SEND", "ECHO", "READY", "BRACHA", "VOTES") # codes are positions, only ever append
+_PHASE_CODES = {phase: code for code, phase in enumerate(PHASES)}
+_PHASE_INLINE = 255
+_FLAG_DELAYED = 1
+
+
+def _write_varint(out: bytearray, value: int) -> None:
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _write_signed(out: bytearray, value: int) -> None:
+    _write_varint(out, value << 1 if value >= 0 else ~(value << 1))
+
+
+def _write_bytes(out: bytearray, value) -> None:
+    _write_varint(out, len(value))
+    out += value
+
+
+def _read_varint(view: memoryview, offset: int) -> Tuple[int, int]:
+    result = 0
+    shift = 0
+    while True:
+        byte = view[offset]
+        offset += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, offset
+        shift += 7
+
+
+def _read_signed(view: memoryview, offset: int) -> Tuple[int, int]:
+    value, offset = _read_varint(view, offset)
+    return (value >> 1) ^ -(value & 1), offset
+
+
+def _read_view(view: memoryview, offset: int) -> Tuple[memoryview, int]:
+    length, offset = _read_varint(view, offset)
+    end = offset + length
+    if end > len(view):
+        raise ValueError("Truncated DolevMessage")
+    return view[offset:end], end
+
+
+def encode(msg) -> bytes:
+    out = bytearray((VERSION,))
+    code = _PHASE_CODES.get(msg.phase)
+    if code is None:
+        out.append(_PHASE_INLINE)
+        _write_bytes(out, msg.phase.encode())
+    else:
+        out.append(code)
+    out.append(_FLAG_DELAYED if msg.is_delayed else 0)
+
+    _write_signed(out, msg.message_id)
+    _write_signed(out, msg.source_id)
+    _write_varint(out, len(msg.path))
+    for hop in msg.path:
+        _write_varint(out, hop)
+    _write_bytes(out, msg.path_mask)
+    _write_bytes(out, msg.packed_path)
+
+    _write_signed(out, msg.u_id)
+    _write_signed(out, msg.author_id)
+    _write_bytes(out, msg.message.encode())
+    _write_bytes(out, msg.vector_clock)
+    _write_varint(out, len(msg.causal_order_queue))
+    for entry in msg.causal_order_queue:
+        _write_signed(out, entry)
+    _write_bytes(out, msg.digest)
+    _write_bytes(out, msg.votes)
+    return bytes(out)
+
+
+class Header(NamedTuple):
+    phase: str
+    is_delayed: bool
+    message_id: int
+    source_id: int
+    path_len: int
+    offset: int # where the path hops start
+
+
+def read_header(data) -> Header:
+    view = data if isinstance(data, memoryview) else memoryview(data)
+    if view[0] != VERSION:
+        raise ValueError(f"Unsupported DolevMessage version {view[0]}")
+    code = view[1]
+    offset = 2
+    if code == _PHASE_INLINE:
+        phase, offset = _read_view(view, offset)
+        phase = str(phase, "utf-8")
+    elif code < len(PHASES):
+        phase = PHASES[code]
+    else:
+        raise ValueError(f"Unknown DolevMessage phase {code}")
+    is_delayed = bool(view[offset] & _FLAG_DELAYED)
+    offset += 1
+
+    message_id, offset = _read_signed(view, offset)
+    source_id, offset = _read_signed(view, offset)
+    path_len, offset = _read_varint(view, offset)
+    return Header(phase, is_delayed, message_id, source_id, path_len, offset)
+
+
+def decode(cls, data):
+    """ Build a `cls` (DolevMessage) from `data`. """
+    view = data if isinstance(data, memoryview) else memoryview(data)
+    header = read_header(view)
+    offset = header.offset
+
+    path: List[int] = []
+    for _ in range(header.path_len):
+        hop, offset = _read_varint(view, offset)
+        path.append(hop)
+    path_mask, offset = _read_view(view, offset)
+    packed_path, offset = _read_view(view, offset)
+
+    u_id, offset = _read_signed(view, offset)
+    author_id, offset = _read_signed(view, offset)
+    message, offset = _read_view(view, offset)
+    vector_clock, offset = _read_view(view, offset)
+    queue_len, offset = _read_varint(view, offset)
+    queue: List[int] = []
+    for _ in range(queue_len):
+        entry, offset = _read_signed(view, offset)
+        queue.append(entry)
+    digest, offset = _read_view(view, offset)
+    votes, offset = _read_view(view, offset)
+
+    # small fields that end up as dict keys or get concatenated are copied, the large ones stay views
+    return cls(u_id, str(message, "utf-8"), header.message_id, header.source_id, path, vector_clock, queue,
+               header.phase, header.is_delayed, author_id, bytes(path_mask), bytes(packed_path), bytes(digest), votes)
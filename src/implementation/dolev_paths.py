@@ -0,0 +1,224 @@
+import struct
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+class DisjointPathPacking:
+    """
+    Incremental packing of the paths collected for one message into node-disjoint ones.
+
+    A stored path is a tuple (origin, i_1, ..., i_k) as built by BasicDolevRC.on_message, where origin is the
+    node the content is trusted to come from and i_1..i_k are the intermediate relays. Only whole received
+    paths are packed: two paths are disjoint when their intermediate relays are, so routes that were never
+    received cannot be stitched together from pieces of others. Paths without intermediates are disjoint from
+    everything.
+
+    Set packing is exact but exponential in the number of paths wanted (f + 1), so the search is kept
+    incremental. A path that is disjoint from the current packing extends it directly. After a failed search
+    for `needed` paths, any packing found later must use one of the paths added since, so the next search is
+    restricted to packings that contain one of those. Removing a path can never create a packing, it only
+    drops the path from the current one.
+    """
+
+    def __init__(self) -> None:
+        self.masks: Dict[tuple, int] = {}
+        self.packing: List[tuple] = []
+        self.packing_mask = 0
+        self.failed: Optional[int] = None # size of the last search that found no packing
+        self.pending: List[tuple] = [] # paths added since that search
+
+    def __len__(self) -> int:
+        return len(self.masks)
+
+    def value(self) -> int:
+        return len(self.packing)
+
+    def add_path(self, path: Iterable[int], mask: int = None) -> bool:
+        """
+        `mask` is the bitmask of the nodes on the path as carried by DolevMessage.path_mask, only the relays
+        are kept of it.
+        """
+        path = tuple(path)
+        if not path or path in self.masks:
+            return False
+        if mask is None:
+            mask = path_mask(path)
+        mask = self.masks[path] = mask & ~(1 << path[0])
+
+        if not mask & self.packing_mask:
+            self.packing.append(path)
+            self.packing_mask |= mask
+        if self.failed is not None:
+            self.pending.append(path)
+        return True
+
+    def remove_path(self, path: Iterable[int]) -> bool:
+        path = tuple(path)
+        if self.masks.pop(path, None) is None:
+            return False
+
+        if path in self.packing:
+            self.packing.remove(path)
+            self.packing_mask = 0
+            for kept in self.packing:
+                self.packing_mask |= self.masks[kept]
+        if path in self.pending:
+            self.pending.remove(path)
+        return True
+
+    def has_disjoint_paths(self, needed: int) -> bool:
+        """
+        Search for `needed` node-disjoint paths among the collected ones, keeping the packing that was found.
+        """
+        if len(self.packing) >= needed:
+            return True
+
+        if self.failed == needed:
+            forced, self.pending = self.pending, []
+        else:
+            forced = None
+        self.failed, self.pending = None, []
+
+        if forced is None:
+            found = self._search(sorted(self.masks, key=len), 0, needed)
+        else:
+            found = None
+            for path in forced:
+                mask = self.masks[path]
+                candidates = sorted((other for other in self.masks if not self.masks[other] & mask and other != path), key=len)
+                rest = self._search(candidates, mask, needed - 1)
+                if rest is not None:
+                    found = [path] + rest
+                    break
+
+        if found is None:
+            self.failed = needed
+            return False
+        self.packing = found
+        self.packing_mask = 0
+        for path in found:
+            self.packing_mask |= self.masks[path]
+        return True
+
+    def disjoint_paths(self) -> List[List[int]]:
+        """
+        The intermediate hop lists of the current packing (direct paths are empty lists).
+        """
+        return [list(path[1:]) for path in self.packing]
+
+    def _search(self, candidates: List[tuple], used: int, needed: int) -> Optional[List[tuple]]:
+        if needed <= 0:
+            return []
+        for index in range(len(candidates) - needed + 1):
+            path = candidates[index]
+            mask = self.masks[path]
+            if mask & used:
+                continue
+            rest = self._search(candidates[index + 1:], used | mask, needed - 1)
+            if rest is not None:
+                return [path] + rest
+        return None
+
+
+class PathCodec:
+    """
+    Compact path encoding for DolevMessage: a fixed-width little-endian bitmask of the nodes on the path
+    plus the hops in order, one byte per hop for networks of up to 256 nodes and two bytes otherwise.
+    """
+
+    def __init__(self, N: int) -> None:
+        self.mask_width = max(1, (N + 7) // 8)
+        self.hop_width = 1 if N <= 256 else 2
+        self._hop_format = "B" if self.hop_width == 1 else "<H"
+
+    def encode(self, path: Iterable[int]) -> Tuple[bytes, bytes]:
+        path = tuple(path)
+        return self.mask_to_bytes(path_mask(path)), self.pack_hops(path)
+
+    def pack_hops(self, path: tuple) -> bytes:
+        if self.hop_width == 1:
+            return bytes(path)
+        return struct.pack(f"<{len(path)}H", *path)
+
+    def unpack_hops(self, packed: bytes) -> tuple:
+        if self.hop_width == 1:
+            return tuple(packed)
+        return struct.unpack(f"<{len(packed) // 2}H", packed)
+
+    def append_hop(self, packed: bytes, node: int) -> bytes:
+        return packed + struct.pack(self._hop_format, node)
+
+    def mask_to_bytes(self, mask: int) -> bytes:
+        return mask.to_bytes(self.mask_width, "little")
+
+    @staticmethod
+    def mask_from_bytes(data: bytes) -> int:
+        return int.from_bytes(data, "little")
+
+
+def path_mask(path: Iterable[int]) -> int:
+    mask = 0
+    for node in path:
+        mask |= 1 << node
+    return mask
+
+
+class MessagePaths:
+    """
+    Per-message path index used by BasicDolevRC.
+
+    Besides the set of collected paths it keeps, for every node, the paths that contain it, while the packing
+    keeps the relay bitmask of every path for the disjointness check. MD3 pruning and the MD2 reset therefore
+    only touch the paths that are actually affected, and the packing is updated in place instead of being
+    rebuilt.
+    """
+
+    def __init__(self) -> None:
+        self.by_node: Dict[int, Set[tuple]] = {}
+        self.packing = DisjointPathPacking()
+
+    def __len__(self) -> int:
+        return len(self.packing)
+
+    def __iter__(self) -> Iterator[tuple]:
+        return iter(self.packing.masks)
+
+    def __contains__(self, path) -> bool:
+        return tuple(path) in self.packing.masks
+
+    def __repr__(self) -> str:
+        return repr(set(self.packing.masks))
+
+    def add(self, path: Iterable[int], mask: int = None) -> bool:
+        path = tuple(path)
+        if not self.packing.add_path(path, mask):
+            return False
+
+        for node in path:
+            self.by_node.setdefault(node, set()).add(path)
+        return True
+
+    def remove(self, path: tuple) -> None:
+        for node in set(path):
+            paths = self.by_node[node]
+            paths.discard(path)
+            if not paths:
+                del self.by_node[node]
+        self.packing.remove_path(path)
+
+    def discard_through(self, node: int) -> int:
+        paths = self.by_node.get(node)
+        if not paths:
+            return 0
+        affected = list(paths)
+        for path in affected:
+            self.remove(path)
+        return len(affected)
+
+    def clear(self) -> None:
+        self.by_node.clear()
+        self.packing = DisjointPathPacking()
+
+    def has_disjoint_paths(self, needed: int) -> bool:
+        return self.packing.has_disjoint_paths(needed)
+
+    def disjoint_paths(self) -> List[List[int]]:
+        return self.packing.disjoint_paths()
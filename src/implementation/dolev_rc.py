@@ -144,20 +144,13 @@ class BasicDolevRC(DistributedAlgorithm):
 
         # print(f"[Node {self.node_id}] Starting algorithm with peers {[x.address for x in self.get_peers()]} and {self.nodes}")
         if self.node_id == self.starting_node:
-            # Checking if all node states are ready
-            all_ready = all([x == "ready" for x in self.node_states.values()])
-            while not all_ready:
-                print(f"[DEBUG] Node {self.node_id} waiting, states={self.node_states}")
-                await asyncio.sleep(1)
-                all_ready = all([x == "ready" for x in self.node_states.values()])
-                
+            print(f"[DEBUG] Node {self.node_id} waiting, states={self.node_states}")
+            await self.wait_until_ready()
             print(f"[DEBUG] Node {self.node_id} has received all ready states, ready to run")
-            await asyncio.sleep(1)
 
         print(f"[DEBUG] Node {self.node_id} peers: {[x.address for x in self.get_peers()]}")
         print(f"[Node {self.node_id}] is ready")
-        for peer in self.get_peers():
-            self.ez_send(peer, ConnectionMessage(self.node_id, "ready"))
+        self.announce_ready()
             
 
     async def on_start_as_starter(self):
@@ -1,4 +1,5 @@
 import asyncio
+import dataclasses
 import datetime
 from enum import Enum
 import os
@@ -8,11 +9,17 @@ from datetime import datetime
 from typing import Dict,List,Optional, Any
 
 from ipv8.community import CommunitySettings
-from ipv8.messaging.payload_dataclass import dataclass
+from ipv8.messaging.payload_headers import BinMemberAuthenticationPayload
+from ipv8.messaging.serialization import Payload
 from ipv8.types import Peer
 
 from src.implementation.node_log import message_logger, OutputMetrics, LOG_LEVEL
+from src.implementation import dolev_codec
+from src.implementation.dolev_paths import MessagePaths, PathCodec, path_mask
+from src.implementation.retention import DuplicateFilter, StateRetention, TombstoneSet
+from src.implementation.message_ids import UID_SEQ_BASE, make_message_id, id_seq, is_well_formed
 from src.system.da_types import DistributedAlgorithm, message_wrapper
+from src.system.msg_history import MessageHistory
 from ..system.da_types import ConnectionMessage
 
 class MessageConfig:
@@ -22,33 +29,71 @@ class MessageConfig:
         self.malicious_nodes = malicious_nodes
         self.f = len(malicious_nodes)
         self.msg_level = msg_level
+        self.compact_paths = False # send paths as a node bitmask plus packed hops instead of a List[int]
+        self.retention_quiescence = 5.0 # seconds a delivered message has to be idle before its state is dropped
+        self.retention_interval = 1.0 # seconds between retention sweeps, None disables them
+        # Bloom filter generation size of the tombstones, shared by retention and the MD5 check (~72 KB each)
+        self.tombstone_capacity = 20_000
+        self.tombstone_fp_rate = 1e-6
+        self.startup_deadline = 30.0 # seconds on_start waits for every neighbour to be ready
+        self.history_size = 0 # sent messages kept by MessageHistory, None keeps all of them
+        self.track_aggregates = False # count messages/bytes per payload type and destination in the node stats
+
+FAKE_PREFIX = "fake behaviour set on: "
 
 class MessageType(Enum):
     SEND = "SEND"
     ECHO = "ECHO"
     READY = "READY"
     BRACHA = "BRACHA"
+    VOTES = "VOTES" # several Bracha ECHO/READY votes in one message, see BrachaRB.flush_votes
+
+@dataclasses.dataclass(eq=False)
+class DolevMessage(Payload):
+    """
+    Serialized with the binary layout of dolev_codec instead of field by field: one "raw" field holds the whole
+    encoding. vector_clock and votes of a received message are memoryviews into the packet.
+    """
+    msg_id = 3 # TODO: should this be different for different messages?
+    format_list = ["raw"]
 
-@dataclass(
-    msg_id=3 # TODO: should this be different for different messages?
-)  # The value 1 identifies this message and must be unique per community.
-class DolevMessage:
     u_id: int
     message: str
     message_id: int
     source_id: int
     path: List[int]
-    vector_clock: List[int]
+    vector_clock: bytes          # VectorClock.to_bytes(), only used for RCO
     causal_order_queue: List[int]
     phase: str = "None"
     is_delayed: bool = True
     author_id: int = -1          # only used for RCO
+    path_mask: bytes = b""       # only used with compact paths, see PathCodec
+    packed_path: bytes = b""
+    digest: bytes = b""          # only used by Bracha, SHA-256 of the content ECHO/READY refer to instead of carrying it
+    votes: bytes = b""           # only used by Bracha VOTES messages, see pack_votes
+
+    def to_pack_list(self):
+        return [("raw", dolev_codec.encode(self))]
+
+    @classmethod
+    def from_unpack_list(cls, raw):
+        return dolev_codec.decode(cls, raw)
+
+    def __setattr__(self, name, value):
+        # Relays rewrite fields in place, so any assignment drops the cached hash
+        object.__setattr__(self, name, value)
+        object.__setattr__(self, "_hash", None)
 
     def __hash__(self):
-        return hash((
-            self.u_id, self.message, self.message_id, self.source_id, tuple(self.path),
-            tuple(self.vector_clock), tuple(self.causal_order_queue), self.phase, self.is_delayed, self.author_id
-        ))
+        cached = self.__dict__.get("_hash")
+        if cached is None:
+            cached = hash((
+                self.u_id, self.message, self.message_id, self.source_id, tuple(self.path),
+                bytes(self.vector_clock), tuple(self.causal_order_queue), self.phase, self.is_delayed, self.author_id,
+                self.path_mask, self.packed_path, self.digest, bytes(self.votes)
+            ))
+            object.__setattr__(self, "_hash", cached)
+        return cached
 
     def __eq__(self, other):
         if not isinstance(other, DolevMessage):
@@ -62,7 +107,11 @@ class DolevMessage:
                 self.causal_order_queue == other.causal_order_queue and
                 self.phase == other.phase and
                 self.is_delayed == other.is_delayed and
-                self.author_id == other.author_id)
+                self.author_id == other.author_id and
+                self.path_mask == other.path_mask and
+                self.packed_path == other.packed_path and
+                self.digest == other.digest and
+                self.votes == other.votes)
 
     
     
@@ -93,8 +142,19 @@ class BasicDolevRC(DistributedAlgorithm):
 
         self.is_delivered: dict[int, bool] = {}
         self.delivered_neighbour: dict[int, set[int]] = {}
-        self.message_paths: dict[int, set[tuple]] = {}
+        self.message_paths: dict[int, MessagePaths] = {}
+        self.delivered_neighbour_mask: dict[int, int] = {}
+        self.compact_paths = parameters.compact_paths
+        self.path_codec = PathCodec(self.N)
         self.message_broadcast_cnt = 0
+        self.uid_cnt = 0
+        # one tombstone set for every retired / delivered id of this node, instead of a Bloom filter pair each
+        self.tombstones = TombstoneSet(parameters.tombstone_capacity, parameters.tombstone_fp_rate)
+        self.retention = StateRetention(parameters.retention_quiescence, tombstones=self.tombstones)
+        self.retention_interval = parameters.retention_interval
+        self.delivered_filter = DuplicateFilter(bloom=self.tombstones) # MD5
+        self.startup_deadline = parameters.startup_deadline
+        self._message_history = MessageHistory(parameters.history_size, parameters.track_aggregates)
 
         #optimization control vairable
         self.MD1 = True
@@ -104,6 +164,8 @@ class BasicDolevRC(DistributedAlgorithm):
         self.MD5 = True
 
         self.add_message_handler(DolevMessage, self.on_message)
+        # Packets pass the header pre-filter before on_message decodes them in full
+        self.decode_map[DolevMessage.msg_id] = self.on_dolev_packet
         
         # log related stuffs
         self.node_outputMetrics = OutputMetrics(self)
@@ -123,13 +185,25 @@ class BasicDolevRC(DistributedAlgorithm):
                                       / self.algortihm_output_file.name)
     
     def generate_message_id(self, msg: str) -> int:
+        '''
+            (node id, sequence, digest of msg) in one int, see message_ids.py. Only for ids of messages this node
+            Dolev-broadcasts: the duplicate filter expects every sequence number of a source to arrive eventually.
+        '''
         self.message_broadcast_cnt += 1
-        return self.node_id * 169 + self.message_broadcast_cnt * 13 + (hash(msg) % 997)
+        return make_message_id(self.node_id, self.message_broadcast_cnt, msg.encode())
+
+    def generate_uid(self, msg: str) -> int:
+        '''
+            Like generate_message_id, for ids that not every node receives as a Dolev message id: Bracha u_ids, and
+            SEND messages that Optim2 keeps from being relayed.
+        '''
+        self.uid_cnt += 1
+        return make_message_id(self.node_id, UID_SEQ_BASE + self.uid_cnt, msg.encode())
     
     def generate_message(self) -> DolevMessage:
         msg =  ''.join([random.choice(['Y', 'M', 'C', 'A']) for _ in range(4)])
         id = self.generate_message_id(msg)
-        return DolevMessage(msg, id, self.node_id, [], [])
+        return DolevMessage(id, msg, id, self.node_id, [], b"", [])
     
     def generate_malicious_msg(self) -> DolevMessage:
 
@@ -140,21 +214,24 @@ class BasicDolevRC(DistributedAlgorithm):
         self.append_output(fake_msg_log)
         print(fake_msg_log)
         
-        return DolevMessage(msg,id,self.node_id,[], [])
+        return DolevMessage(id, msg, id, self.node_id, [], b"", [])
     
     def mal_modify_msg(self, payload: DolevMessage) ->  DolevMessage:
 
         if payload:
             original_msg = payload.message
-            fake_message = f"fake behaviour set on: {original_msg}"
-            fake_id = hash(fake_message) # self.generate_message_id(fake_message)
+            if original_msg.startswith(FAKE_PREFIX): # already tampered, relayed as is so fakes do not pile up
+                return payload, False
+            fake_message = f"{FAKE_PREFIX}{original_msg}"
+            # derived from the original id, so every tamper of one message yields the same fake and MD5 drops repeats.
+            # Authored by this node, so the source's duplicate watermark never mistakes the fake for the original
+            fake_id = make_message_id(self.node_id, id_seq(payload.message_id) or 1, fake_message.encode())
 
-        
             fake_msg_log = f"[Malicious Node {self.node_id}] tampered the original msg"
             self.append_output(fake_msg_log)
             print(fake_msg_log)
 
-            return DolevMessage(fake_message, fake_id, payload.source_id, payload.path, []), True
+            return DolevMessage(payload.u_id, fake_message, fake_id, payload.source_id, payload.path, b"", []), True
 
     def execute_mal_process(self, msg) -> DolevMessage:
 
@@ -183,65 +260,55 @@ class BasicDolevRC(DistributedAlgorithm):
         self.msg_log.logger.setLevel(self.msg_level.value)
 
         self.msg_log.update_log_path(self.gen_output_file_path())
-        self.msg_log.log(LOG_LEVEL.DEBUG, f"Message Log Init Succesfully, with Node {self.node_id}, Output_Path {self.algortihm_output_file}")
+        self.msg_log.log(LOG_LEVEL.DEBUG, "Message Log Init Succesfully, with Node %s, Output_Path %s", self.node_id, self.algortihm_output_file)
 
     async def on_start(self):
 
         self.init_logger()
 
+        if self.retention_interval:
+            self.register_task("retention_sweep", self.collect_garbage, interval=self.retention_interval, delay=self.retention_interval)
+
         if self.node_id in self.malicious_nodes:
             self.is_malicious = True
-            self.msg_log.log(LOG_LEVEL.DEBUG, f"Hi I am malicious {self.node_id}")
+            self.msg_log.log(LOG_LEVEL.DEBUG, "Hi I am malicious %s", self.node_id)
 
-        all_ready = False
         # print(f"[Node {self.node_id}] Starting algorithm with peers {[x.address for x in self.get_peers()]} and {self.nodes}")
-        while not all_ready:
-
-            all_ready = all(
-                state == "ready"
-                for node_id, state in self.node_states.items()
-            )
-
-            for peer in self.get_peers():
-                self.ez_send(peer, ConnectionMessage(self.node_id, "ready"))
-
-            if not all_ready:
-                self.msg_log.log(LOG_LEVEL.DEBUG, f"Node {self.node_id} waiting, states={self.node_states}")
-                await asyncio.sleep(2) # this is enough to make the logic stack look happy
-            
-            else:
-                self.msg_log.log(LOG_LEVEL.DEBUG, f"[Node {self.node_id}] is ready")
-                self.msg_log.log(LOG_LEVEL.DEBUG, f"[Node {self.node_id}] ready, states={self.node_states}")
-                self.msg_log.log(LOG_LEVEL.DEBUG, f"[Node {self.node_id}] peers: {[x.address for x in self.get_peers()]}")
+        self.announce_ready()
+        self.msg_log.log(LOG_LEVEL.DEBUG, "Node %s waiting, states=%s", self.node_id, self.node_states)
+        await self.wait_until_ready()
+        self.msg_log.log(LOG_LEVEL.DEBUG, "[Node %s] is ready", self.node_id)
+        self.msg_log.log(LOG_LEVEL.DEBUG, "[Node %s] ready, states=%s", self.node_id, self.node_states)
+        self.msg_log.log(LOG_LEVEL.DEBUG, "[Node %s] peers: %s", self.node_id, [x.address for x in self.get_peers()])
 
         if self.node_id in self.starter_nodes:
             for cnt in range(self.starter_nodes[self.node_id]): # allow multiple messages from one starter
-                self.msg_log.log(LOG_LEVEL.DEBUG, f"[Node {self.node_id}] is starting. Round: {cnt}")
+                self.msg_log.log(LOG_LEVEL.DEBUG, "[Node %s] is starting. Round: %s", self.node_id, cnt)
                 await self.on_start_as_starter()
 
     async def on_start_as_starter(self):
         # By default we broadcast a message as starter, but everyone should be able to trigger a broadcast as well.
-        self.msg_log.log(LOG_LEVEL.DEBUG, f"[Node {self.node_id}] entering on_start_as_starter")
+        self.msg_log.log(LOG_LEVEL.DEBUG, "[Node %s] entering on_start_as_starter", self.node_id)
 
         message = self.generate_message()
-        self.msg_log.log(LOG_LEVEL.DEBUG, f"[Node {self.node_id}] Generated message: {message}")
+        self.msg_log.log(LOG_LEVEL.DEBUG, "[Node %s] Generated message: %s", self.node_id, message)
         await self.on_broadcast(message)
 
 
     async def on_broadcast(self, message: DolevMessage) -> None:
         # Assuming everything has been set up well for this node (delivered, paths, ...)
 
-        self.msg_log.log(LOG_LEVEL.DEBUG, f"[Node {self.node_id}] is starting Dolev's protocol")
+        self.msg_log.log(LOG_LEVEL.DEBUG, "[Node %s] is starting Dolev's protocol", self.node_id)
 
-        peers = self.get_peers()
+        peers = self.neighbours()
 
-        self.msg_log.log(LOG_LEVEL.DEBUG, f"[Node {self.node_id}] entering on_broadcast, Peers count: {len(peers)}")
+        self.msg_log.log(LOG_LEVEL.DEBUG, "[Node %s] entering on_broadcast, Peers count: %s", self.node_id, len(peers))
 
 
-        self.msg_log.log(LOG_LEVEL.DEBUG, f"log the bracha msg at first {message.u_id}")
+        self.msg_log.log(LOG_LEVEL.DEBUG, "log the bracha msg at first %s", message.u_id)
         self.msg_log.get_deliver_info_msg(message.u_id)
         self.msg_log.set_metric_start_time(message.u_id)
-        self.msg_log.get_deliver_info_msg(message.message_id).u_id = message.u_id
+        self.msg_log.link_phase_msg(message.message_id, message.u_id)
         self.set_metics_start_time(message.message_id)
 
         #if the node is a malicious node, then generate a fake msg to deliver to maximum f 
@@ -251,26 +318,56 @@ class BasicDolevRC(DistributedAlgorithm):
         else:
             max_broadcast_cnt = len(peers)
         try:
-            for peer in peers[:max_broadcast_cnt]:
-                peer_id = self.node_id_from_peer(peer)
-                broad_cast_log = f"[Node {self.node_id}] Broadcast Message: {message.message_id} , {message.phase} to node {peer_id}"
-                self.msg_log.log(LOG_LEVEL.DEBUG,broad_cast_log)
-                
-                self.ez_send(peer, message)
+            for peer_id, peer in peers[:max_broadcast_cnt]:
+                self.msg_log.log(LOG_LEVEL.DEBUG, "[Node %s] Broadcast Message: %s , %s to node %s", self.node_id, message.message_id, message.phase, peer_id)
+
+            self.multicast([peer for _, peer in peers[:max_broadcast_cnt]], message)
 
         except Exception as e:
             self.msg_log.log(LOG_LEVEL.ERROR, f"Error in on_broadcast: {e}")
             raise e
         
-        self.msg_log.log(LOG_LEVEL.DEBUG, f"[Node {self.node_id}] delivered self-broadcasted message {message.message_id}")
+        self.msg_log.log(LOG_LEVEL.DEBUG, "[Node %s] delivered self-broadcasted message %s", self.node_id, message.message_id)
+        self.retention.touch(message.message_id)
         await self.trigger_delivery(message)
 
+    def on_dolev_packet(self, source_address, data: bytes):
+        '''
+            Runs the discard checks of on_message on the packet header, so the duplicates that make up most of the
+            traffic in dense topologies are dropped before the signature check and the full decode. Malicious nodes
+            rewrite messages before these checks and therefore see every packet.
+        '''
+        if self.node_id not in self.malicious_nodes:
+            try:
+                # the community prefix and the message id byte come before the authentication header
+                _, offset = self.serializer.unpack_serializable(BinMemberAuthenticationPayload, data,
+                                                                offset=len(self.get_prefix()) + 1)
+                header = dolev_codec.read_header(memoryview(data)[offset:])
+            except Exception: # malformed, left to the regular decode to reject
+                header = None
+            if header is not None and self.discard_early(self.address_ids.get(source_address), header):
+                return None
+        return self.on_message(source_address, data)
+
+    def discard_early(self, sender_id, header: dolev_codec.Header) -> bool:
+        '''
+            Only decides, the packet is not authenticated yet: retention and metrics are left to on_message.
+        '''
+        message_id = header.message_id
+        if (self.retention.is_retired(message_id) or
+                (self.MD5 and self.is_duplicate(header.source_id, message_id)) or
+                (self.MD4 and sender_id in self.delivered_neighbour.get(message_id, ()))):
+            self.msg_log.log(LOG_LEVEL.DEBUG, "[Node %s] discarded msg %s from its header", self.node_id, message_id)
+            return True
+        return False
+
     @message_wrapper(DolevMessage)
     async def on_message(self, peer: Peer, payload: DolevMessage) -> None:
         self.is_malicious = (self.node_id in self.malicious_nodes)
 
         sender_id = self.node_id_from_peer(peer)
-        source_id, message_id, msg_path = payload.source_id,payload.message_id,payload.path
+        source_id, message_id = payload.source_id,payload.message_id
+        msg_path, msg_mask = self.read_path(payload)
 
         self.msg_log.log(LOG_LEVEL.DEBUG, payload)
 
@@ -279,63 +376,68 @@ class BasicDolevRC(DistributedAlgorithm):
 
         if is_msg_modified :
             sender_id = None
-            source_id, message_id, msg_path = new_payload.source_id,new_payload.message_id,new_payload.path
-            
+            source_id, message_id = new_payload.source_id,new_payload.message_id
+            msg_path, msg_mask = self.read_path(new_payload)
+
+        if self.retention.is_retired(message_id): # late duplicate of a message whose state was already dropped
+            self.msg_log.log(LOG_LEVEL.DEBUG, "[Node %s] received msg %s after its state was retired, can be discarded", self.node_id, message_id)
+            return
+        self.retention.touch(message_id)
 
         self.msg_log.get_deliver_info_msg(new_payload.u_id).byte_sent += len(new_payload.message)
         self.msg_log.get_deliver_info_msg(new_payload.message_id).byte_sent += len(new_payload.message)
 
-        if self.MD5 and self.is_delivered.get(message_id):  #if msg is delivered already, it can be discarded
+        if self.MD5 and self.is_duplicate(source_id, message_id):  #if msg is delivered already, it can be discarded
 
-            MD5_log = f"MD5: [Node {self.node_id}] received a msg already delivered, can be discarded"
-            self.msg_log.log(LOG_LEVEL.DEBUG,MD5_log)
+            self.msg_log.log(LOG_LEVEL.DEBUG, "MD5: [Node %s] received a msg already delivered, can be discarded", self.node_id)
             
             return
 
         if self.MD4 and self.delivered_neighbour.get(message_id) and sender_id in self.delivered_neighbour.get(message_id) :  #if msg is from a delivered neighbour, it can be dsicarded
             
-            MD4_log = f"MD4: [Node {self.node_id}] received a msg {payload.phase} from delivered neighbour, can be discarded"
-            self.msg_log.log(LOG_LEVEL.DEBUG,MD4_log)
+            self.msg_log.log(LOG_LEVEL.DEBUG, "MD4: [Node %s] received a msg %s from delivered neighbour, can be discarded", self.node_id, payload.phase)
             return
 
-        if self.MD3 and not msg_path:   #if msg_path is empty, indicate the sender has delivered the msg (#MD2)
+        # sender_id is None for a message this node rewrote itself, there is no delivered sender to record then
+        if self.MD3 and not msg_path and sender_id is not None:   #if msg_path is empty, indicate the sender has delivered the msg (#MD2)
 
             self.delivered_neighbour.setdefault(message_id, set()).add(sender_id)
+            self.delivered_neighbour_mask[message_id] = self.delivered_neighbour_mask.get(message_id, 0) | (1 << sender_id)
             #remove all paths in the path that contains the sender since its delivered and can be discarded
             if self.message_paths.get(message_id):
-                updated_paths = set(tuple([path for path in self.message_paths.get(message_id) if sender_id not in path]))
-                self.message_paths[message_id] = updated_paths
+                self.message_paths[message_id].discard_through(sender_id)
 
-            MD3_log = f"MD3: [Node {self.node_id} received msg with empty path from delivered node {sender_id}]"
-            self.msg_log.log(LOG_LEVEL.DEBUG, MD3_log)
+            self.msg_log.log(LOG_LEVEL.DEBUG, "MD3: [Node %s received msg with empty path from delivered node %s]", self.node_id, sender_id)
 
         try:
             if sender_id is not None:
-                new_path = msg_path + [sender_id]
+                new_path = msg_path + (sender_id,)
+                new_mask = msg_mask | (1 << sender_id)
             else:
-                new_path = msg_path
+                new_path, new_mask = msg_path, msg_mask
 
-            recieved_log = f"[Node {self.node_id}] Got message: {payload.phase} - {new_payload.message_id} from node: {sender_id} with path {new_path}"
-            self.msg_log.log(LOG_LEVEL.DEBUG,recieved_log)
+            self.msg_log.log(LOG_LEVEL.DEBUG, "[Node %s] Got message: %s - %s from node: %s with path %s", self.node_id, payload.phase, new_payload.message_id, sender_id, new_path)
 
             #increment msg log stat
 
             #log the bracha msg at first
-            self.msg_log.log(LOG_LEVEL.DEBUG, f"log the bracha msg at first {new_payload.u_id}")
+            self.msg_log.log(LOG_LEVEL.DEBUG, "log the bracha msg at first %s", new_payload.u_id)
             self.msg_log.get_deliver_info_msg(new_payload.u_id)
             self.msg_log.set_metric_start_time(new_payload.u_id)
 
-            self.msg_log.get_deliver_info_msg(new_payload.message_id).u_id = new_payload.u_id
+            self.msg_log.link_phase_msg(new_payload.message_id, new_payload.u_id)
             self.set_metics_start_time(new_payload.message_id)
             self.log_message_cnt(new_payload.message_id)
 
-            self.message_paths.setdefault(new_payload.message_id, set()).add(tuple(new_path))
-            self.msg_log.log(LOG_LEVEL.DEBUG, f'Node {self.node_id}, {payload.message_id} message paths: {self.message_paths.get(payload.message_id)}')
+            paths = self.message_paths.get(new_payload.message_id)
+            if paths is None:
+                paths = self.message_paths[new_payload.message_id] = MessagePaths()
+            paths.add(new_path, new_mask)
+            self.msg_log.log(LOG_LEVEL.DEBUG, 'Node %s, %s message paths: %s', self.node_id, payload.message_id, self.message_paths.get(payload.message_id))
             
             #MD1 If a process preceives a content directly from the source s, then p directly delivers it.
             if self.MD1 and not self.is_malicious and not self.is_delivered.get(message_id) and sender_id == source_id:
-                MD1_log = f"MD1: [Node {self.node_id}] is a direct neighbour of Sender {sender_id} for the message {message_id}, it will be delivered"
-                self.msg_log.log(LOG_LEVEL.DEBUG, MD1_log)
+                self.msg_log.log(LOG_LEVEL.DEBUG, "MD1: [Node %s] is a direct neighbour of Sender %s for the message %s, it will be delivered", self.node_id, sender_id, message_id)
 
                 await self.trigger_delivery(new_payload)
 
@@ -345,54 +447,91 @@ class BasicDolevRC(DistributedAlgorithm):
 
             # if not self.is_malicious and not self.is_delivered.get(message_id) and self.new_find_disjoint_paths_ok(message_id):
 
-            self.msg_log.log(LOG_LEVEL.DEBUG, f"{self.is_malicious} and not {self.is_delivered.get(message_id)} and {self.find_disjoint_paths_ok(message_id)}:")
+            if self.msg_log.is_enabled(LOG_LEVEL.DEBUG):
+                self.msg_log.log(LOG_LEVEL.DEBUG, "%s and not %s and %s:", self.is_malicious, self.is_delivered.get(message_id), self.find_disjoint_paths_ok(message_id))
             if not self.is_malicious and not self.is_delivered.get(message_id) and self.find_disjoint_paths_ok(message_id):
 
                 # print(f"Node {self.node_id} has enough node-disjoint paths, delivering message: {payload.message}")
-                disjoint_path_find_log = f"[Node {self.node_id}] Enough node-disjoint paths found for {message_id}, message will be delivered"
-                self.msg_log.log(LOG_LEVEL.DEBUG, disjoint_path_find_log)
+                self.msg_log.log(LOG_LEVEL.DEBUG, "[Node %s] Enough node-disjoint paths found for %s, message will be delivered", self.node_id, message_id)
 
                 await self.trigger_delivery(new_payload)
 
-            #all node that can be skipped
-            node_to_skip = set(new_path)
-            node_to_skip.update([source_id, self.node_id])
+            #all node that can be skipped, as a bitmask over node ids
+            node_to_skip = new_mask | (1 << self.node_id)
+            if source_id is not None and source_id >= 0: # a rewritten message can carry any source
+                node_to_skip |= 1 << source_id
 
             if self.MD3:
-                if self.delivered_neighbour.get(message_id):
-                    node_to_skip.update(self.delivered_neighbour.get(message_id))
+                node_to_skip |= self.delivered_neighbour_mask.get(message_id, 0)
 
             # MD.2 If a process p has delivered a message, then it can discard all the related
             # paths and relay the content only with an empty path to all of its neighbors.
             if self.MD2 and self.is_delivered.get(message_id) :
-                new_path = []
-                self.message_paths[message_id] = set()
+                new_path, new_mask = (), 0
+                self.message_paths.pop(message_id, None)
 
-            for neighbor in self.get_peers():
-                neighbor_id = self.node_id_from_peer(neighbor)
+            # the relayed payload is the same for every neighbour, so it is only rewritten once
+            payload.message = new_payload.message
+            payload.message_id = new_payload.message_id
+            payload.source_id = new_payload.source_id # since we dont care about dolev byzantine node, lets do this for now
+            self.write_path(payload, new_path, new_mask)
+
+            relay_targets = []
+            for neighbor_id, neighbor in self.neighbours():
 
                 # MD2 
                 if self.MD2 and self.is_delivered.get(message_id) and len(new_path) != 0 :
-                    MD2_log = f"MD2: [Node {self.node_id}] condition met, msg {message_id} delivered, it will not be send to its neighbour]"
-                    self.msg_log.log(LOG_LEVEL.DEBUG, MD2_log)
+                    self.msg_log.log(LOG_LEVEL.DEBUG, "MD2: [Node %s] condition met, msg %s delivered, it will not be send to its neighbour]", self.node_id, message_id)
                     break
 
-                if payload.is_delayed and (neighbor_id not in node_to_skip):
+                if payload.is_delayed and not (node_to_skip >> neighbor_id) & 1:
 
-                    msg_log = f"[Node {self.node_id}] Sent message to node {neighbor_id} with path {new_path} : {payload.message}"
-                    self.msg_log.log(LOG_LEVEL.DEBUG, msg_log)
+                    self.msg_log.log(LOG_LEVEL.DEBUG, "[Node %s] Sent message to node %s with path %s : %s", self.node_id, neighbor_id, new_path, payload.message)
 
-                    payload.message = new_payload.message
-                    payload.message_id = new_payload.message_id
-                    payload.source_id = new_payload.source_id # since we dont care about dolev byzantine node, lets do this for now
-                    payload.path = new_path
+                    relay_targets.append(neighbor)
 
-                    self.ez_send(neighbor, payload)
+            self.multicast(relay_targets, payload)
            
         except Exception as e:
             self.msg_log.log(LOG_LEVEL.ERROR, f"Error in on_message: {e}")
             raise e
 
+    def is_duplicate(self, source_id, message_id) -> bool:
+        '''
+            MD5 check. Live state is exact, ids whose state was already dropped are answered by the duplicate filter.
+        '''
+        delivered = self.is_delivered.get(message_id)
+        if delivered is not None:
+            return delivered
+        return self.delivered_filter.seen(source_id, message_id, self.message_seq(source_id, message_id))
+
+    def message_seq(self, source_id, message_id):
+        '''
+            Sequence number of ids the source created itself, these are tracked exactly by the duplicate filter.
+        '''
+        if not is_well_formed(message_id, source_id):
+            return None
+        seq = id_seq(message_id)
+        return seq if seq < UID_SEQ_BASE else None
+
+    def read_path(self, payload: DolevMessage) -> tuple[tuple, int]:
+        if self.compact_paths:
+            path = self.path_codec.unpack_hops(payload.packed_path)
+            mask = self.path_codec.mask_from_bytes(payload.path_mask)
+            # the mask decides disjointness, a relay must not be able to hide nodes from it
+            if mask != path_mask(path):
+                mask = path_mask(path)
+            return path, mask
+        return tuple(payload.path), path_mask(payload.path)
+
+    def write_path(self, payload: DolevMessage, path: tuple, mask: int) -> None:
+        if self.compact_paths:
+            payload.path = []
+            payload.path_mask = self.path_codec.mask_to_bytes(mask)
+            payload.packed_path = self.path_codec.pack_hops(path)
+        else:
+            payload.path = list(path)
+
     def generate_relay_message(self, payload: DolevMessage) -> DolevMessage:
         if self.is_malicious and (self.node_id not in self.starter_nodes):
             return self.execute_mal_process(payload)
@@ -407,9 +546,10 @@ class BasicDolevRC(DistributedAlgorithm):
                     self.msg_log.log(LOG_LEVEL.WARNING, "Never mind. It's my own message.")
 
             self.is_delivered.update({message.message_id: True })
-            self.write_metrics(message.message_id)
+            self.delivered_filter.add(message.source_id, message.message_id, self.message_seq(message.source_id, message.message_id))
+            self.write_metrics(message.message_id, message.phase)
             
-            self.msg_log.log(LOG_LEVEL.DEBUG, f"New Delivered Messages: Message ID: {message.message_id}, TYPE: {message.phase}")
+            self.msg_log.log(LOG_LEVEL.DEBUG, "New Delivered Messages: Message ID: %s, TYPE: %s", message.message_id, message.phase)
 
             #for msg_id, status in self.is_delivered.items():
             #    self.msg_log.log(LOG_LEVEL.DEBUG, f"Delivered Messages: Message ID: {msg_id}, Delivered: {status}")
@@ -422,30 +562,40 @@ class BasicDolevRC(DistributedAlgorithm):
             raise e    
     
     def find_disjoint_paths_ok(self, msg_id) -> bool:
-        # TODO: Very likely to be wrong and thus causing nodes to not deliver a correct message.
+        '''
+            Exact check for f+1 node-disjoint paths: set packing over the whole paths that were received.
+            The packing is kept per message id, so a new path only costs the searches that must contain it.
+        '''
 
-        if not self.message_paths.get(msg_id):
+        paths = self.message_paths.get(msg_id)
+        if not paths:
             return False
-        
-        # print(f"The paths to be checked: {self.message_paths.get(msg_id)}")
-        disjoint_paths = []
-        used_nodes = set()
-        paths_sorted = sorted(self.message_paths.get(msg_id), key=len)
-        
-        for path in paths_sorted:
-            path = path[1:]
-            if not set(path).intersection(used_nodes):
-                disjoint_paths.append(list(path))
-                used_nodes.update(path)
-
-                if len(disjoint_paths) >= (self.f + 1):
-
-                    path_log = f"[Node {self.node_id}] Terminate, disjoint paths: {disjoint_paths}" 
-                    self.append_output(path_log)
-                    #print(path_log)
-                    return True
+
+        if paths.has_disjoint_paths(self.f + 1):
+
+            path_log = f"[Node {self.node_id}] Terminate, disjoint paths: {paths.disjoint_paths()}"
+            self.append_output(path_log)
+            #print(path_log)
+            return True
         return False
 
+    def collect_garbage(self):
+        for message_id in self.retention.collect(lambda message_id: self.is_delivered.get(message_id, False)):
+            self.retire_message(message_id)
+
+    def retire_message(self, message_id):
+        '''
+            Drop the state of a delivered, quiescent message. Later copies are discarded through the tombstones.
+        '''
+        self.is_delivered.pop(message_id, None)
+        self.delivered_neighbour.pop(message_id, None)
+        self.delivered_neighbour_mask.pop(message_id, None)
+        self.message_paths.pop(message_id, None)
+        self.forget_message_metrics(message_id)
+
+    def forget_message_metrics(self, message_id):
+        self.msg_log.forget_metrics(message_id)
+
     # region Loggin Functions
     def log_message_cnt(self, message_id):
         self.msg_log.log_message_cnt(message_id)
@@ -453,8 +603,8 @@ class BasicDolevRC(DistributedAlgorithm):
     def set_metics_start_time(self, msg_id):
        self.msg_log.set_metric_start_time(msg_id)
         
-    def set_metric_end_time(self,msg_id):
-        self.msg_log.set_metric_end_time(msg_id)
+    def set_metric_end_time(self, msg_id, layer=None, phase=None):
+        self.msg_log.set_metric_end_time(msg_id, layer, phase)
 
     def log_delivered_status(self, message_id, status=True):
         self.msg_log.set_metric_delivered_status(message_id, True)
@@ -462,8 +612,8 @@ class BasicDolevRC(DistributedAlgorithm):
     def log_message_history(self):
         self.msg_log.set_message_history(len(self._message_history), self._message_history.bytes_sent())
 
-    def write_metrics(self, message_id):
+    def write_metrics(self, message_id, phase=None):
         self.log_delivered_status(message_id, True)
-        self.set_metric_end_time(message_id)
+        self.set_metric_end_time(message_id, "rc", phase if phase != "None" else None) # plain Dolev messages have no phase
         self.log_message_history()
     #endregion
\ No newline at end of file
@@ -0,0 +1,48 @@
+"""
+Message identifiers that are unique across nodes and stable across processes.
+
+An id packs (author, sequence, short content digest) into one positive 64-bit integer, so it travels as a fixed-width
+int field of the ipv8 payloads:
+
+    | author (12 bits) | sequence (31 bits) | digest (20 bits) |
+
+(author, sequence) is unique as long as every node draws the ids it creates from its counters, which use disjoint
+ranges of sequence numbers (see UID_SEQ_BASE). The digest
+(BLAKE2b of the content, unlike hash() not salted per process) ties the id to what it identifies.
+"""
+from hashlib import blake2b
+
+AUTHOR_BITS = 12
+SEQ_BITS = 31
+DIGEST_BITS = 20
+
+MAX_AUTHOR = (1 << AUTHOR_BITS) - 1
+MAX_SEQ = (1 << SEQ_BITS) - 1
+# Ids that not every node receives as a Dolev message id (Bracha u_ids, unrelayed SEND messages) count from here,
+# so the sequence numbers below stay gapless for the per-source watermark of the duplicate filter
+UID_SEQ_BASE = 1 << (SEQ_BITS - 1)
+
+
+def short_digest(content: bytes) -> int:
+    return int.from_bytes(blake2b(content, digest_size=4).digest(), "big") >> (32 - DIGEST_BITS)
+
+
+def make_message_id(author: int, seq: int, content: bytes = b"") -> int:
+    if not 0 <= author <= MAX_AUTHOR:
+        raise ValueError(f"Author {author} does not fit in {AUTHOR_BITS} bits")
+    if not 0 < seq <= MAX_SEQ:
+        raise ValueError(f"Sequence number {seq} does not fit in {SEQ_BITS} bits")
+    return (author << (SEQ_BITS + DIGEST_BITS)) | (seq << DIGEST_BITS) | short_digest(content)
+
+
+def id_author(message_id: int) -> int:
+    return message_id >> (SEQ_BITS + DIGEST_BITS)
+
+
+def id_seq(message_id: int) -> int:
+    return (message_id >> DIGEST_BITS) & MAX_SEQ
+
+
+def is_well_formed(message_id: int, author: int) -> bool:
+    """ Whether `message_id` follows this scheme and was created by `author`. """
+    return 0 < message_id < (1 << 63) and id_author(message_id) == author and id_seq(message_id) > 0
@@ -1,11 +1,14 @@
 import logging
+import logging.handlers
 import csv
+import queue
 
 import asyncio
+import time
 
 from enum import Enum
 from pathlib import Path
-from typing import Dict, Literal, Set
+from typing import Dict, List, Literal, Set
 from datetime import datetime
 
 class LOG_LEVEL(Enum):
@@ -14,22 +17,128 @@ class LOG_LEVEL(Enum):
     WARNING = logging.WARNING
     ERROR = logging.ERROR
 
+class _log_entry:
+    '''
+        Lazy log line: nothing is formatted for a disabled level. Enabled records are formatted by
+        QueueHandler.prepare in the logging thread, so the line shows the arguments as they were at the call
+        (payloads are rewritten in place later); the listener thread only writes.
+    '''
+    __slots__ = ("node_id", "level", "msg", "args")
+
+    def __init__(self, node_id, level, msg, args):
+        self.node_id = node_id
+        self.level = level
+        self.msg = msg
+        self.args = args
+
+    def __str__(self):
+        msg = self.msg % self.args if self.args else self.msg
+        return f'{self.node_id} | {self.level} | {msg}'
+
+class BatchedFileHandler(logging.FileHandler):
+    '''
+        FileHandler that only flushes its stream every `batch_size` records (or on ERROR / explicit flush),
+        so the writer thread does one write syscall per batch instead of one per line.
+    '''
+    def __init__(self, filename, batch_size: int = 256):
+        super().__init__(filename)
+        self.batch_size = batch_size
+        self._pending = 0
+
+    def emit(self, record):
+        try:
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.write(self.format(record) + self.terminator)
+            self._pending += 1
+            if self._pending >= self.batch_size or record.levelno >= logging.ERROR:
+                self.flush()
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        self._pending = 0
+        super().flush()
+
 class delivered_msg_info : 
     def __init__(self):
         self.u_id: int = 0
         self.start_time: float = None  # Initialize as None to indicate it's unset
+        self.start_clock: float = None # monotonic, latencies are measured on this one
         self.end_time: float = None
         self.latency: float = 0.0
         self.is_delivered: bool = False
         self.recieved_cnt: int = 0
         self.byte_sent: int = 0
 
+class LatencyHistogram:
+    '''
+        HDR-style log-linear histogram of latencies, in microseconds. Values are grouped per power of two and every
+        group is split into 2**precision_bits linear sub-buckets, so a recorded value is off by at most
+        2**-(precision_bits - 1) relative (< 1% with the default), whatever its magnitude. Memory grows with the number of
+        distinct buckets hit, not with the number of samples.
+    '''
+    def __init__(self, precision_bits: int = 8):
+        self.precision_bits = precision_bits
+        self.counts: Dict[int, int] = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def _index(self, value: int) -> int:
+        shift = max(0, value.bit_length() - self.precision_bits)
+        return (shift << self.precision_bits) + (value >> shift)
+
+    def _upper_bound(self, index: int) -> int:
+        shift = index >> self.precision_bits
+        sub_bucket = index - (shift << self.precision_bits)
+        return ((sub_bucket + 1) << shift) - 1
+
+    def record(self, seconds: float):
+        value = max(0, int(seconds * 1_000_000))
+        index = self._index(value)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, q: float) -> float:
+        '''
+            Latency in ms below which a fraction `q` of the samples falls (highest value of the bucket, capped at max).
+        '''
+        if not self.count:
+            return None
+        rank = max(1, round(q * self.count))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(self._upper_bound(index), self.max) / 1000
+        return self.max / 1000
+
+    def summary(self) -> Dict:
+        if not self.count:
+            return {"count": 0}
+        return {
+            "count": self.count,
+            "min": self.min / 1000,
+            "mean": round(self.total / self.count / 1000, 3),
+            "p50": self.percentile(0.50),
+            "p90": self.percentile(0.90),
+            "p99": self.percentile(0.99),
+            "p999": self.percentile(0.999),
+            "max": self.max / 1000,
+            "buckets": [[self._upper_bound(index) / 1000, self.counts[index]] for index in sorted(self.counts)],
+        }
+
 class OutputMetrics:
     total_node_count: int = 0
     total_byzantine_count: int = 0
     total_connectivity: int = 0
 
-    delivered_u_id: Set[int] = set()
+    delivered_u_id: Set[int]
     delivered_info: Dict[int, delivered_msg_info]
     delivered_msg_cnt: int = 0
     message_recieved: int
@@ -43,13 +152,20 @@ class OutputMetrics:
             self.total_connectivity = curAlgorithm.connectivity
 
         self.delivered_info = {}
+        self.delivered_u_id = set()
+        self.unflushed_u_id: Dict[int, None] = {} # (ordered set) whose summary row changed since the last CSV flush
+        self.unflushed_rows: List[list] = [] # final rows of messages whose metrics were already dropped
+        self.phase_msg_ids: Dict[int, Set[int]] = {} # u_id -> ids of the phase messages carrying it
     
+    def msg_summary_row(self, msg_id):
+        info = self.delivered_info[msg_id]
+        return [msg_id, info.start_time, info.end_time, info.latency, info.is_delivered, info.recieved_cnt, info.byte_sent]
+
     def msg_summary_toString(self):
 
         msg_summary_list = [
-            f"{msg_id}, {info.start_time}, {info.end_time}, {info.latency}, "
-            f"{info.is_delivered}, {info.recieved_cnt}, {info.byte_sent}"
-            for msg_id, info in self.delivered_info.items() if msg_id in self.delivered_u_id
+            ", ".join(str(item) for item in self.msg_summary_row(msg_id))
+            for msg_id in self.delivered_info if msg_id in self.delivered_u_id
         ]
 
         return "\n".join(msg_summary_list)
@@ -64,22 +180,49 @@ class message_logger:
         self.logger = logging.getLogger(f'NodeLog-{self.node_id}')
         self.logger.setLevel(msg_log_level.value)
 
-        self.file_handler = logging.FileHandler(self.log_file_path)
+        # Records are handed to a queue and written by a QueueListener thread, the event loop never touches the file
+        self.log_queue = queue.SimpleQueue()
+        self.queue_handler = logging.handlers.QueueHandler(self.log_queue)
+        self.logger.addHandler(self.queue_handler)
+
         if isinstance(msg_log_level, LOG_LEVEL):
             level = msg_log_level.value
         else:
             level = LOG_LEVEL.INFO.value
-        self.file_handler.setLevel(level)
+        self.file_handler = self._make_file_handler(level)
+        self.listener = self._start_listener()
+
+        self.now = datetime.now # metric timestamps, the simulator swaps in its virtual clock
+        self.clock = time.monotonic # latencies, idem
+        self.histograms: Dict[str, LatencyHistogram] = {} # "layer" and "layer.phase" -> delivery latencies
+        self._summary_path = None # msg summary file this logger has already created
+        self._flush_cnt = 0
+        self.compact_interval = 100
+
+    def _make_file_handler(self, level):
+        file_handler = BatchedFileHandler(self.log_file_path)
+        file_handler.setLevel(level)
 
         formatter = logging.Formatter('%(message)s')
-        self.file_handler.setFormatter(formatter)
-        self.logger.addHandler(self.file_handler)
+        file_handler.setFormatter(formatter)
+        return file_handler
+
+    def _start_listener(self):
+        listener = logging.handlers.QueueListener(self.log_queue, self.file_handler, respect_handler_level=True)
+        listener.start()
+        self.listening = True
+        return listener
+
+    def _stop_listener(self):
+        # Drains the queue; records logged afterwards stay queued until a listener is started again
+        if self.listening:
+            self.listener.stop()
+            self.listening = False
 
     def update_log_path(self, log_file_path):
-        # Close the current file handler to release the file
+        # Drain the queue and close the current file handler to release the file
+        self._stop_listener()
         self.file_handler.close()
-        # Remove the old file handler from the logger
-        self.logger.removeHandler(self.file_handler)
 
         # Set the new log file path
         self.log_file_path = log_file_path
@@ -88,44 +231,69 @@ class message_logger:
         if not log_dir.exists():
             log_dir.mkdir(parents=True, exist_ok=True) 
 
-        # Create a new file handler with the updated path
-        self.file_handler = logging.FileHandler(self.log_file_path)
-        self.file_handler.setLevel(self.logger.level)  # Retain the current log level
-
-        # Reapply the formatter
-        formatter = logging.Formatter('%(message)s')
-        self.file_handler.setFormatter(formatter)
-
-        # Add the new file handler to the logger
-        self.logger.addHandler(self.file_handler)
-
-    def log(self, level, msg):
+        # Create a new file handler with the updated path, retaining the current log level
+        self.file_handler = self._make_file_handler(self.logger.level)
+        self.listener = self._start_listener()
 
-        log_entry = f'{self.node_id} | {level} | {msg}'
+    def is_enabled(self, level) -> bool:
+        return self.logger.isEnabledFor(level.value)
 
-        if level == LOG_LEVEL.INFO:
-            self.logger.info(log_entry)
-        elif level == LOG_LEVEL.DEBUG:
-            self.logger.debug(log_entry)
-        elif level == LOG_LEVEL.WARNING:
-            self.logger.warning(log_entry)
-        elif level == LOG_LEVEL.ERROR:
-            self.logger.error(log_entry)
-        else:
+    def log(self, level, msg, *args):
+        '''
+            `msg` may use %-style placeholders for `args`; nothing is formatted unless `level` is enabled.
+        '''
+        if not isinstance(level, LOG_LEVEL):
             raise ValueError(f"Unknown log level: {level}")
+        if not self.logger.isEnabledFor(level.value):
+            return
+        self.logger.log(level.value, _log_entry(self.node_id, level, msg, args))
+
+    def close(self):
+        # Final rows of everything still in memory (counts keep growing after delivery), compaction keeps the latest
+        self.log_metrics.unflushed_u_id.update(dict.fromkeys(self.log_metrics.delivered_u_id))
+        self.write_unflushed_rows()
+        self.compact_msg_summary_csv()
+        # The logger is process-global, a handler left on it would keep queueing records nobody drains
+        self.logger.removeHandler(self.queue_handler)
+        self._stop_listener()
+        self.file_handler.close()
     
     def get_deliver_info_msg(self,msg_id) -> delivered_msg_info: 
         return self.log_metrics.delivered_info.setdefault(msg_id,delivered_msg_info())
 
     def set_metric_start_time(self, msg_id):
-        if not self.get_deliver_info_msg(msg_id).start_time:
-            self.get_deliver_info_msg(msg_id).start_time = datetime.now()
-
-    def set_metric_end_time(self,msg_id):
-        self.get_deliver_info_msg(msg_id).end_time = datetime.now()
-        latency = self.get_deliver_info_msg(msg_id).end_time - self.get_deliver_info_msg(msg_id).start_time
-        latency = round(latency.total_seconds() * 1000,3)
-        self.get_deliver_info_msg(msg_id).latency = latency
+        info = self.get_deliver_info_msg(msg_id)
+        if not info.start_time:
+            info.start_time = self.now()
+            info.start_clock = self.clock()
+
+    def set_metric_end_time(self, msg_id, layer=None, phase=None):
+        info = self.get_deliver_info_msg(msg_id)
+        info.end_time = self.now()
+        latency = self.record_latency(msg_id, layer, phase)
+        if latency is not None:
+            info.latency = round(latency * 1000, 3)
+
+    def record_latency(self, msg_id, layer=None, phase=None):
+        '''
+            Seconds since `msg_id` was first seen, also added to the `layer` and `layer.phase` histograms when a layer
+            is given. None if the start was never recorded.
+        '''
+        info = self.log_metrics.delivered_info.get(msg_id)
+        if info is None or info.start_clock is None:
+            return None
+        latency = self.clock() - info.start_clock
+        if layer is not None:
+            keys = (layer, f"{layer}.{phase}") if phase is not None else (layer,)
+            for key in keys:
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = self.histograms[key] = LatencyHistogram()
+                histogram.record(latency)
+        return latency
+
+    def latency_summary(self) -> Dict[str, Dict]:
+        return {key: self.histograms[key].summary() for key in sorted(self.histograms)}
 
     def set_metric_delivered_status(self,msg_id, status=True):
         self.log_metrics.delivered_msg_cnt += 1
@@ -138,14 +306,32 @@ class message_logger:
         self.log_metrics.message_recieved = message_recieved
         self.log_metrics.byte_sent = byte_sent
 
+    def link_phase_msg(self, msg_id, u_id):
+        self.get_deliver_info_msg(msg_id).u_id = u_id
+        self.log_metrics.phase_msg_ids.setdefault(u_id, set()).add(msg_id)
+
+    def forget_metrics(self, *msg_ids):
+        '''
+            Drop the per-message metrics of retired messages. Their final summary row is queued for the next flush,
+            it supersedes the row written at delivery.
+        '''
+        metrics = self.log_metrics
+        for msg_id in msg_ids:
+            if msg_id in metrics.delivered_u_id and msg_id in metrics.delivered_info:
+                metrics.unflushed_u_id.pop(msg_id, None)
+                metrics.unflushed_rows.append(metrics.msg_summary_row(msg_id))
+            metrics.delivered_info.pop(msg_id, None)
+            metrics.delivered_u_id.discard(msg_id)
+            metrics.phase_msg_ids.pop(msg_id, None)
+
     #for bracha only for now
     def log_msg_summary(self,u_id,msg_type):
         self.log_metrics.delivered_u_id.add(u_id)
+        self.log_metrics.unflushed_u_id[u_id] = None
         bracha_msg = self.get_deliver_info_msg(u_id)
-        list_phase_msg = [msg_info for msg_info in self.log_metrics.delivered_info.values() if msg_info.u_id == u_id]
-        
-        time_diff = (bracha_msg.end_time - bracha_msg.start_time)
-        bracha_msg.latency = round(time_diff.total_seconds() * 1000,3)
+        list_phase_msg = [self.log_metrics.delivered_info[msg_id] for msg_id in self.log_metrics.phase_msg_ids.get(u_id, ())
+                          if msg_id in self.log_metrics.delivered_info]
+
         bracha_msg.recieved_cnt = sum(phase_msg.recieved_cnt for phase_msg in list_phase_msg)
         #bracha_msg.byte_sent = sum(phase_msg.byte_sent for phase_msg in list_phase_msg)
 
@@ -160,35 +346,60 @@ class message_logger:
     def msg_summary_toString(self):
         return self.log_metrics.msg_summary_toString()
     
-    def output_msg_summary_to_csv(self, metrics_summary):
-        csv_output_path = (self.log_file_path.parent
-                           / f"{self.log_file_path.stem}-msg_summary.csv")
-        
-        is_file_exist = csv_output_path.exists() and csv_output_path.stat().st_size > 0
+    MSG_SUMMARY_HEADER = [
+        "msg_id",
+        "start_time",
+        "end_time",
+        "latency",
+        "is_delivered",
+        "recieved_cnt",
+        "byte_sent"
+    ]
+
+    def msg_summary_csv_path(self):
+        return (self.log_file_path.parent
+                / f"{self.log_file_path.stem}-msg_summary.csv")
+
+    def output_msg_summary_to_csv(self, rows):
+        '''
+            Append-only: only the given rows are written. The file is (re)created with its header the first time
+            this logger writes to a path, a row for an id that was already written supersedes the older one.
+        '''
+        csv_output_path = self.msg_summary_csv_path()
+
+        mode = "a" if csv_output_path == self._summary_path else "w"
+        with open(csv_output_path, mode, newline="") as csv_output:
 
-        metrics_list = [item.strip() for item in metrics_summary.split("\n")]
+            writer = csv.writer(csv_output)
 
-        header = [
-            "msg_id",
-            "start_time",
-            "end_time",
-            "latency",
-            "is_delivered",
-            "recieved_cnt",
-            "byte_sent"
-        ]
-        
-        with open(csv_output_path, "w", newline="") as csv_output:
+            if mode == "w":
+                writer.writerow(self.MSG_SUMMARY_HEADER)
+                self._summary_path = csv_output_path
 
-            writer = csv.writer(csv_output)
+            writer.writerows(rows)
 
-            writer.writerow(header)
-            
-            for metric in metrics_list:
-                metric_data = metric.split(", ")
-                writer.writerow(metric_data)
+        self.log(LOG_LEVEL.DEBUG, "Node %s outputs to CSV File %s", self.node_id, csv_output_path)
 
-        self.log(LOG_LEVEL.DEBUG, f"Node {self.node_id} outputs to CSV File {csv_output_path}")
+    def compact_msg_summary_csv(self):
+        '''
+            Rewrite the summary keeping only the latest row per msg_id, in first-written order.
+        '''
+        csv_output_path = self.msg_summary_csv_path()
+        if csv_output_path != self._summary_path:
+            return
+
+        with open(csv_output_path, "r", newline="") as csv_input:
+            reader = csv.reader(csv_input)
+            header = next(reader, self.MSG_SUMMARY_HEADER)
+            latest = {}
+            for row in reader:
+                if row:
+                    latest[row[0]] = row
+
+        with open(csv_output_path, "w", newline="") as csv_output:
+            writer = csv.writer(csv_output)
+            writer.writerow(header)
+            writer.writerows(latest.values())
 
     def output_metrics_to_csv(self,metrics_summary) :
         
@@ -220,14 +431,22 @@ class message_logger:
 
         self.log(LOG_LEVEL.DEBUG, f"Node {self.node_id} outputs to CSV File {csv_output_path}")
     
+    def write_unflushed_rows(self):
+        metrics = self.log_metrics
+        new_rows = metrics.unflushed_rows + [metrics.msg_summary_row(u_id) for u_id in metrics.unflushed_u_id
+                                             if u_id in metrics.delivered_info]
+        metrics.unflushed_rows = []
+        metrics.unflushed_u_id.clear()
+        self.output_msg_summary_to_csv(new_rows)
+
     # Write the log output to files \ this should occure every time a deliver event is triggered?
     def flush(self):
 
-        msg_summary_list = self.msg_summary_toString()
-
-        metrics_summary = self.metric_summary_toString()
-
         self.file_handler.flush()
-        self.output_msg_summary_to_csv(msg_summary_list)
-        #self.output_metrics_to_csv(metrics_summary)
+        self.write_unflushed_rows()
+        #self.output_metrics_to_csv(self.metric_summary_toString())
+
+        self._flush_cnt += 1
+        if self._flush_cnt % self.compact_interval == 0:
+            self.compact_msg_summary_csv()
 
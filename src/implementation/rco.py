@@ -1,31 +1,102 @@
 import random
 import datetime
 import asyncio
-import time
+
+from collections import deque
+from typing import Dict, Iterator, List, Optional, Tuple
 
 from ipv8.community import CommunitySettings
 
 from src.implementation.dolev_rc_new import DolevMessage, MessageType
 from src.implementation.node_log import LOG_LEVEL
 from src.implementation.bracha_rb import BrachaRB, BrachaConfig
+from src.system.delay import DelayInjector
+from src.implementation.vector_clock import DeltaClockDecoder, VectorClock
 
 class RCOConfig(BrachaConfig):
-    def __init__(self, broadcasters={0:1, 1:1}, malicious_nodes=[], N=10, msg_level=LOG_LEVEL.WARNING, causal_broadcast = {0: [8,8,9,6,4], 1: [2,3,5]}):
+    def __init__(self, broadcasters={0:1, 1:1}, malicious_nodes=[], N=10, msg_level=LOG_LEVEL.WARNING, causal_broadcast = {0: [8,8,9,6,4], 1: [2,3,5]},
+                 delay_config = {"default": ("choice", [0, 2])}, delta_clocks = False):
         """
         Previously, we use broadcasters = {1:2, 2:1, ...} to launch concurrent broadcasts.
         From now on, the messages should be made causally related.
         The way we do this is to have the message specify its successor(s), i.e. the next node to broadcast.
         eg. If a message is "#msg_content#4698" sent by 1, then broadcasts will go as 1->8->9->6->4->end 
+
+        delay_config holds the DelayInjector arguments (default / per_type / per_link / seed) that delay the
+        hand-over of BRB-delivered messages to the causal layer, links are (author, receiver).
+
+        With delta_clocks, messages only carry the clock entries that changed since the author's previous broadcast,
+        every node of a run has to use the same setting.
         """
         super().__init__(broadcasters, malicious_nodes, N, msg_level)
         self.causal_broadcast = causal_broadcast
+        self.delay_config = delay_config
+        self.delta_clocks = delta_clocks
+
+class CausalPendingBuffer:
+    """
+    Messages waiting for causal delivery, indexed by the clock entry they are blocked on.
+
+    A message with clock V is filed under (k, V[k]) for the first k where the local clock is still behind.
+    The local clock only ever moves up by one, so once VC[k] reaches c exactly the entries filed under (k, c)
+    are woken and re-filed under their next missing entry (or become ready), nothing else is looked at.
+    """
+
+    def __init__(self):
+        self.waiting: Dict[Tuple[int, int], List[Tuple[int, DolevMessage, VectorClock]]] = {}
+        self.ready: deque[Tuple[int, DolevMessage]] = deque()
+        self.size = 0
+
+    def add(self, author: int, msg: DolevMessage, local_clock: VectorClock, clock: VectorClock = None):
+        self.size += 1
+        if clock is None:
+            clock = VectorClock.from_bytes(msg.vector_clock)
+        self._file(author, msg, clock, local_clock.first_missing(clock))
+
+    def _file(self, author, msg, clock, k):
+        if k is None or k < 0:
+            self.ready.append((author, msg))
+        else:
+            self.waiting.setdefault((k, clock[k]), []).append((author, msg, clock))
+
+    def wake(self, k: int, local_clock: VectorClock):
+        """ Called after local_clock[k] was incremented, the woken clocks are compared in one batch. """
+        entries = self.waiting.pop((k, local_clock[k]), None)
+        if not entries:
+            return
+        missing = local_clock.first_missing_batch([clock for _, _, clock in entries])
+        for (author, msg, clock), k_missing in zip(entries, missing.tolist()):
+            self._file(author, msg, clock, k_missing)
+
+    def pop_ready(self) -> Optional[Tuple[int, DolevMessage]]:
+        if not self.ready:
+            return None
+        self.size -= 1
+        return self.ready.popleft()
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self) -> Iterator[Tuple[int, DolevMessage]]:
+        yield from self.ready
+        for entries in self.waiting.values():
+            for author, msg, _ in entries:
+                yield author, msg
+
+    def __repr__(self):
+        return f"CausalPendingBuffer(ready={len(self.ready)}, waiting={ {key: len(v) for key, v in self.waiting.items()} })"
 
 class RCO(BrachaRB):
     def __init__(self, settings: CommunitySettings, parameters=RCOConfig()):
         super().__init__(settings, parameters)
         self.causal_broadcast = parameters.causal_broadcast
-        self.vector_clock = [0 for _ in range(self.N)]
-        self.pending: set[tuple[int, DolevMessage]] = set()
+        self.vector_clock = VectorClock.zeros(self.N)
+        self.delta_clocks = parameters.delta_clocks
+        self.last_broadcast_clock = VectorClock.zeros(self.N) # base of the next delta we send
+        self.clock_chain_len = 0
+        self.clock_decoder = DeltaClockDecoder(self.N)
+        self.pending = CausalPendingBuffer()
+        self.delay_injector = DelayInjector.from_config(parameters.delay_config)
 
     def gen_output_file_path(self, test_name: str = "RCO_TEST"):
         return super().gen_output_file_path(test_name)
@@ -37,12 +108,14 @@ class RCO(BrachaRB):
         await super().on_start_as_starter()
 
     def compare_vector_lock(self, new_VC) -> bool:
-        vec_compare_result = all(v >= nv for v, nv in zip(self.vector_clock, new_VC))
-        self.msg_log.log(self.msg_level, f"Comparing Vectors: {self.vector_clock} >= {new_VC}, {vec_compare_result}")
+        if not isinstance(new_VC, VectorClock):
+            new_VC = VectorClock.from_bytes(new_VC)
+        vec_compare_result = self.vector_clock.dominates(new_VC)
+        self.msg_log.log(self.msg_level, "Comparing Vectors: %s >= %s, %s", self.vector_clock, new_VC, vec_compare_result)
         return vec_compare_result
 
     def generate_message(self, old_queue = None) -> DolevMessage:
-        msg = f"msg_{self.message_broadcast_cnt+1}th_" + \
+        msg = f"msg_{self.uid_cnt+1}th_" + \
         "".join([random.choice(['TUD', 'NUQ', 'LOO', 'THU']) for _ in range(6)])
 
         if old_queue is None:
@@ -51,70 +124,93 @@ class RCO(BrachaRB):
             #old_queue.pop(0)
             queue = old_queue.copy()
 
-        u_id = self.get_uid_pred()
-        msg_id = self.generate_message_id(msg)
+        u_id = self.get_uid_pred(msg)
         author_id = self.node_id
-        return DolevMessage(u_id, msg, msg_id, self.node_id, [],
-                            self.vector_clock, queue, MessageType.BRACHA.value, True, author_id)
+        return DolevMessage(u_id, msg, u_id, self.node_id, [],
+                            self.encode_clock(), queue, MessageType.BRACHA.value, True, author_id)
+
+    def encode_clock(self) -> bytes:
+        if not self.delta_clocks:
+            return self.vector_clock.to_bytes()
+
+        clock_bytes = self.vector_clock.to_delta_bytes(self.last_broadcast_clock, self.clock_chain_len)
+        self.last_broadcast_clock = self.vector_clock.copy()
+        self.clock_chain_len += 1
+        return clock_bytes
 
     async def on_broadcast(self, message: DolevMessage):
         """ upon event < RCO, Broadcast | M > do """
 
-        self.msg_log.log(self.msg_level, f"Node {self.node_id} is RCO broadcasting: {message.message}")
+        self.msg_log.log(self.msg_level, "Node %s is RCO broadcasting: %s", self.node_id, message.message)
 
         self.trigger_RCO_delivery(message)
         await super().on_broadcast(message)
-        self.vector_clock[self.node_id] += 1
+        self.vector_clock.increment(self.node_id)
+        # messages from others may already depend on this broadcast
+        self.pending.wake(self.node_id, self.vector_clock)
+        self.deliver_pending()
 
     def trigger_Bracha_Delivery(self, payload):
         """ upon event < RB, Deliver | M > do """
 
-        time.sleep(random.choice([0, 2]))
-        # apply random delay
-
         super().trigger_Bracha_Delivery(payload)
+
+        # apply random delay, without blocking the event loop
+        delay = self.delay_injector.delay_for(payload.phase, (payload.author_id, self.node_id))
+        if delay > 0:
+            self.register_anonymous_task("delayed_rco_handover", self.on_bracha_delivered, payload, delay=delay)
+        else:
+            self.on_bracha_delivered(payload)
+
+    def on_bracha_delivered(self, payload):
         author = payload.author_id
 
-        self.msg_log.log(self.msg_level, f"Node {self.node_id} BRB Delivered: {payload.message} from {author}")
+        self.msg_log.log(self.msg_level, "Node %s BRB Delivered: %s from %s", self.node_id, payload.message, author)
 
         if author != self.node_id: 
-            self.pending.add((author, payload))
+            # the author may be Byzantine, a clock that does not fit this network must not reach the pending set
+            try:
+                if not 0 <= author < self.N:
+                    raise ValueError(f"Unknown author {author}")
+                if self.delta_clocks:
+                    decoded = self.clock_decoder.decode(author, payload.vector_clock, payload)
+                else:
+                    decoded = [(payload, VectorClock.from_bytes(payload.vector_clock, self.N))]
+            except ValueError as e:
+                self.msg_log.log(LOG_LEVEL.WARNING, "Node %s dropped message %s with a malformed clock from %s: %s",
+                                 self.node_id, payload.u_id, author, e)
+                return
+            for msg, clock in decoded:
+                self.pending.add(author, msg, self.vector_clock, clock)
 
-            self.msg_log.log(self.msg_level, f"My pending: {self.pending}")
+            self.msg_log.log(self.msg_level, "My pending: %s", self.pending)
 
             self.deliver_pending()
 
     def deliver_pending(self):
         """ procedure deliver pending """
 
-        self.msg_log.log(self.msg_level, f"Node {self.node_id} is entering deliver_pending")
+        self.msg_log.log(self.msg_level, "Node %s is entering deliver_pending", self.node_id)
 
-        while True:
-            to_keep = set()
-            flag = False
-            for author, msg in self.pending:
-                if self.compare_vector_lock(msg.vector_clock):
-                    self.trigger_RCO_delivery(msg)
-                    self.vector_clock[author] += 1
+        while (entry := self.pending.pop_ready()) is not None:
+            author, msg = entry
+            self.trigger_RCO_delivery(msg)
+            self.vector_clock.increment(author)
 
-                    self.msg_log.log(self.msg_level, f"VC[{author}] increased by 1. Current: {self.vector_clock}")
+            self.msg_log.log(self.msg_level, "VC[%s] increased by 1. Current: %s", author, self.vector_clock)
 
-                    flag = True
-                else:
-                    to_keep.add((author, msg))
-            self.pending = to_keep
-            if not flag:
-                break
+            self.pending.wake(author, self.vector_clock)
         
     def trigger_RCO_delivery(self, payload: DolevMessage):
         """ upon event < RCO, Deliver | M > do """
 
         delivered_time = datetime.datetime.now()
         author = payload.author_id
-        self.msg_log.log(self.msg_level, f"Node {self.node_id} RCO Delivered a message:<{payload.message}>. Time: {delivered_time}. Author: {author}.")
+        self.msg_log.record_latency(payload.u_id, "rco")
+        self.msg_log.log(self.msg_level, "Node %s RCO Delivered a message:<%s>. Time: %s. Author: %s.", self.node_id, payload.message, delivered_time, author)
 
         queue = payload.causal_order_queue
-        self.msg_log.log(self.msg_level,f"{queue}, {type(queue)}")
+        self.msg_log.log(self.msg_level, "%s, %s", queue, type(queue))
 
         # if queue:
         #     queue_top = queue[0]
@@ -137,5 +233,5 @@ class RCO(BrachaRB):
                 new_payload = self.generate_message([]) #this will generate a message that does not continue the causal order queue
             else:
                 new_payload = self.generate_message(queue)
-                self.msg_log.log(self.msg_level, f"Node {self.node_id} is the next broadcaster for message: <{new_payload}>.")
+                self.msg_log.log(self.msg_level, "Node %s is the next broadcaster for message: <%s>.", self.node_id, new_payload)
             asyncio.create_task(self.on_broadcast(new_payload))
\ No newline at end of file
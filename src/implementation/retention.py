@@ -0,0 +1,158 @@
+import hashlib
+import math
+import time
+
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, List, Optional, Set
+
+
+class BloomFilter:
+    """
+    Fixed-size Bloom filter sized for `capacity` keys at a false-positive rate of about `fp_rate`.
+    Keys are hashed through their str(), so ints and tuples of ints are stable across processes.
+    """
+
+    def __init__(self, capacity: int, fp_rate: float = 1e-6):
+        self.capacity = capacity
+        self.fp_rate = fp_rate
+        self.num_bits = max(8, math.ceil(-capacity * math.log(fp_rate) / (math.log(2) ** 2)))
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key: Hashable):
+        digest = hashlib.blake2b(str(key).encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, key: Hashable) -> None:
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def is_full(self) -> bool:
+        return self.count >= self.capacity
+
+    def __contains__(self, key: Hashable) -> bool:
+        return all(self.bits[pos >> 3] >> (pos & 7) & 1 for pos in self._positions(key))
+
+    def __len__(self):
+        return self.count
+
+
+class TombstoneSet:
+    """
+    Remembers retired keys in two Bloom filter generations. When the current generation is full it becomes the
+    previous one and the oldest is dropped, so memory is bounded and a key is remembered for at least
+    `capacity` retirements, with at most about 2 * fp_rate false positives.
+    """
+
+    def __init__(self, capacity: int = 20_000, fp_rate: float = 1e-6):
+        self.capacity = capacity
+        self.fp_rate = fp_rate
+        self.current = BloomFilter(capacity, fp_rate)
+        self.previous = None
+
+    def add(self, key: Hashable) -> None:
+        if self.current.is_full():
+            self.previous = self.current
+            self.current = BloomFilter(self.capacity, self.fp_rate)
+        self.current.add(key)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.current or (self.previous is not None and key in self.previous)
+
+    def __len__(self):
+        return len(self.current) + (len(self.previous) if self.previous is not None else 0)
+
+
+class DuplicateFilter:
+    """
+    Memory-bounded check for "was this message already delivered".
+
+    Messages that carry a per-source sequence number (starting at 1) are tracked exactly: a watermark per source
+    below which everything was seen, plus the seqs seen ahead of it. If more than `max_ahead` seqs are waiting for a
+    gap that never fills, the oldest are moved to the Bloom filter. Messages without a seq only go to the Bloom
+    filter. Lookups are O(1); a Bloom answer can be a false positive at about `fp_rate`.
+
+    `bloom` can be a TombstoneSet shared with a StateRetention: the keys stored here are tuples, they never collide
+    with retired ids.
+    """
+
+    def __init__(self, capacity: int = 20_000, fp_rate: float = 1e-6, max_ahead: int = 1024,
+                 bloom: Optional[TombstoneSet] = None):
+        self.max_ahead = max_ahead
+        self.watermarks: Dict[int, int] = {}
+        self.ahead: Dict[int, Set[int]] = {}
+        self.bloom = bloom if bloom is not None else TombstoneSet(capacity, fp_rate)
+
+    def add(self, source: int, key: Hashable, seq: Optional[int] = None) -> None:
+        if seq is None:
+            self.bloom.add((source, key))
+            return
+
+        watermark = self.watermarks.get(source, 0)
+        if seq <= watermark:
+            return
+        ahead = self.ahead.setdefault(source, set())
+        ahead.add(seq)
+        while watermark + 1 in ahead:
+            watermark += 1
+            ahead.remove(watermark)
+        self.watermarks[source] = watermark
+
+        if len(ahead) > self.max_ahead:
+            for spilled in sorted(ahead)[:len(ahead) - self.max_ahead]:
+                ahead.remove(spilled)
+                self.bloom.add((source, "seq", spilled))
+
+    def seen(self, source: int, key: Hashable, seq: Optional[int] = None) -> bool:
+        if seq is None:
+            return (source, key) in self.bloom
+        return (seq <= self.watermarks.get(source, 0) or seq in self.ahead.get(source, ())
+                or (source, "seq", seq) in self.bloom)
+
+
+class StateRetention:
+    """
+    Decides when per-message protocol state can be dropped.
+
+    Protocols `touch` a key whenever a message for it is handled. `collect` retires the keys that have been idle
+    for `quiescence` seconds and that the protocol reports as done; the caller then drops their state.
+    Retired keys go into a TombstoneSet so late duplicates can still be recognised and discarded.
+    """
+
+    def __init__(self, quiescence: float = 5.0, tombstone_capacity: int = 20_000, fp_rate: float = 1e-6,
+                 clock: Callable[[], float] = time.monotonic, tombstones: Optional[TombstoneSet] = None):
+        self.quiescence = quiescence
+        self.clock = clock
+        self.last_active: OrderedDict[Hashable, float] = OrderedDict() # least recently touched first
+        # can be shared between retentions whose keys never collide, one Bloom filter pair per node is enough
+        self.tombstones = tombstones if tombstones is not None else TombstoneSet(tombstone_capacity, fp_rate)
+
+    def touch(self, key: Hashable) -> None:
+        self.last_active[key] = self.clock()
+        self.last_active.move_to_end(key)
+
+    def is_retired(self, key: Hashable) -> bool:
+        # a key with live state is never reported as retired, whatever the Bloom filter says
+        return key not in self.last_active and key in self.tombstones
+
+    def collect(self, is_done: Callable[[Hashable], bool]) -> List[Hashable]:
+        deadline = self.clock() - self.quiescence
+        retired = []
+        for key, last_active in self.last_active.items():
+            if last_active > deadline:
+                break
+            if is_done(key):
+                retired.append(key)
+
+        for key in retired:
+            del self.last_active[key]
+            self.tombstones.add(key)
+        return retired
+
+    def __len__(self):
+        return len(self.last_active)
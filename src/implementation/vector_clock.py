@@ -0,0 +1,149 @@
+import struct
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+
+class VectorClock:
+    """
+    Vector clock backed by a packed unsigned integer array.
+
+    Dominance tests are vectorized and the clock travels as raw little-endian uint32 bytes
+    (4 bytes per entry instead of 8 for a List[int] payload field), see `to_bytes` / `from_bytes`.
+    """
+    __slots__ = ("values",)
+
+    DTYPE = np.dtype("<u4")
+
+    def __init__(self, values: Iterable[int]):
+        self.values = np.array(values, dtype=self.DTYPE)
+
+    @classmethod
+    def zeros(cls, n: int) -> "VectorClock":
+        return cls(np.zeros(n, dtype=cls.DTYPE))
+
+    @classmethod
+    def from_bytes(cls, data: bytes, n: Optional[int] = None) -> "VectorClock":
+        """ Raises ValueError when `data` is not a clock (of `n` entries, if given). """
+        if len(data) % cls.DTYPE.itemsize or (n is not None and len(data) != n * cls.DTYPE.itemsize):
+            raise ValueError(f"Clock of {len(data)} bytes, expected {n} entries of {cls.DTYPE.itemsize} bytes")
+        clock = cls.__new__(cls)
+        clock.values = np.frombuffer(data, dtype=cls.DTYPE).copy()
+        return clock
+
+    def to_bytes(self) -> bytes:
+        return self.values.tobytes()
+
+    # Delta layout: chain index (uint32), entry count (uint16), indices (uint16[count]), values (uint32[count])
+    DELTA_HEADER = struct.Struct("<IH")
+    INDEX_DTYPE = np.dtype("<u2")
+
+    def to_delta_bytes(self, base: "VectorClock", chain_index: int) -> bytes:
+        """ Only the entries that differ from `base`, tagged with the position of this clock in its author's chain. """
+        idx = np.flatnonzero(self.values != base.values).astype(self.INDEX_DTYPE)
+        return self.DELTA_HEADER.pack(chain_index, idx.size) + idx.tobytes() + self.values[idx].tobytes()
+
+    @classmethod
+    def parse_delta(cls, data: bytes, n: Optional[int] = None) -> Tuple[int, np.ndarray, np.ndarray]:
+        """ Raises ValueError when `data` is not a delta (of a clock of `n` entries, if given). """
+        if len(data) < cls.DELTA_HEADER.size:
+            raise ValueError("Truncated clock delta header")
+        chain_index, count = cls.DELTA_HEADER.unpack_from(data)
+        offset = cls.DELTA_HEADER.size
+        if len(data) != offset + count * (cls.INDEX_DTYPE.itemsize + cls.DTYPE.itemsize):
+            raise ValueError(f"Clock delta of {len(data)} bytes does not hold {count} entries")
+        idx = np.frombuffer(data, dtype=cls.INDEX_DTYPE, count=count, offset=offset)
+        values = np.frombuffer(data, dtype=cls.DTYPE, count=count, offset=offset + idx.nbytes)
+        if n is not None and count and int(idx.max()) >= n:
+            raise ValueError(f"Clock delta entry {int(idx.max())} out of range for {n} nodes")
+        return chain_index, idx, values
+
+    def apply_delta(self, idx: np.ndarray, values: np.ndarray) -> "VectorClock":
+        clock = self.copy()
+        clock.values[idx] = values
+        return clock
+
+    def copy(self) -> "VectorClock":
+        return VectorClock(self.values)
+
+    def increment(self, k: int):
+        self.values[k] += 1
+
+    def dominates(self, other: "VectorClock") -> bool:
+        """ self >= other entry-wise, i.e. everything `other` depends on has been seen here. """
+        return bool(np.all(self.values >= other.values))
+
+    def first_missing(self, other: "VectorClock") -> Optional[int]:
+        """ Lowest k with self[k] < other[k], None if self dominates other. """
+        missing = np.flatnonzero(self.values < other.values)
+        return int(missing[0]) if missing.size else None
+
+    def first_missing_batch(self, others: Sequence["VectorClock"]) -> np.ndarray:
+        """ `first_missing` for many clocks at once, -1 where self already dominates. """
+        if not others:
+            return np.empty(0, dtype=np.int64)
+        matrix = np.stack([other.values for other in others])
+        behind = self.values < matrix
+        return np.where(behind.any(axis=1), behind.argmax(axis=1), -1)
+
+    def __getitem__(self, k):
+        return int(self.values[k])
+
+    def __len__(self):
+        return len(self.values)
+
+    def __iter__(self):
+        return iter(self.values.tolist())
+
+    def __eq__(self, other):
+        if not isinstance(other, VectorClock):
+            return NotImplemented
+        return np.array_equal(self.values, other.values)
+
+    def __hash__(self):
+        return hash(self.to_bytes())
+
+    def __repr__(self):
+        return f"VectorClock({self.values.tolist()})"
+
+
+class DeltaClockDecoder:
+    """
+    Rebuilds full clocks from delta-encoded ones.
+
+    Each author encodes its clocks against its own previous broadcast, so a delta can only be applied once all
+    earlier clocks of that author are known. Deltas that arrive early are held back and released in chain order;
+    only the last full clock per author is kept.
+    """
+
+    def __init__(self, n: int):
+        self.n = n
+        self.last: Dict[int, Tuple[int, VectorClock]] = {} # author -> (next chain index, last decoded clock)
+        self.held: Dict[int, Dict[int, Tuple[object, np.ndarray, np.ndarray]]] = {}
+
+    def decode(self, author: int, data: bytes, item=None) -> List[Tuple[object, VectorClock]]:
+        """
+        Returns the (item, clock) pairs that became decodable, in the author's broadcast order. Raises ValueError
+        for a malformed delta, which is then not held back.
+        """
+        chain_index, idx, values = VectorClock.parse_delta(data, self.n)
+        next_index, clock = self.last.get(author, (0, None))
+        if chain_index < next_index:
+            return [] # already decoded
+        held = self.held.setdefault(author, {})
+        held[chain_index] = (item, idx, values)
+
+        if clock is None:
+            clock = VectorClock.zeros(self.n)
+        decoded = []
+        while next_index in held:
+            item, idx, values = held.pop(next_index)
+            clock = clock.apply_delta(idx, values)
+            decoded.append((item, clock))
+            next_index += 1
+        self.last[author] = (next_index, clock)
+        return decoded
+
+    def __len__(self):
+        """ Number of deltas waiting for an earlier clock of their author. """
+        return sum(len(held) for held in self.held.values())
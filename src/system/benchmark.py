@@ -0,0 +1,241 @@
+"""
+Throughput benchmark for the Dolev, Bracha and RCO implementations.
+
+Every configuration of the matrix (algorithm x N x connectivity x f x broadcasters) is run in the simulator (see
+src/system/simulator.py), each in a fresh process so that peak RSS belongs to that run only; a run that does not
+finish within --timeout seconds is killed and reported as such. Reported per run: deliveries per wall-clock second
+of the run itself (building the nodes and their keys excluded), p50/p99 broadcast-to-delivery latency (virtual
+time), packets and bytes per delivered broadcast and peak RSS.
+
+    python -m src.system.benchmark -a dolev -a bracha -a rco -n 10 -n 20 -k 5 -f 0 -f 1 -b 1 -b 3 \\
+        --json output/bench.json --csv output/bench.csv
+"""
+import asyncio
+import csv
+import inspect
+import itertools
+import json
+import resource
+import subprocess
+import sys
+from multiprocessing import Pool, TimeoutError
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import click
+
+from src.system.simulator import default_parameters, run_simulation
+
+# Top-layer broadcast/delivery of every benchmarked algorithm: (delivery method, key identifying the broadcast)
+LAYERS = {
+    "dolev": ("trigger_delivery", lambda msg: msg.message_id),
+    "bracha": ("trigger_Bracha_Delivery", lambda msg: msg.u_id),
+    "rco": ("trigger_RCO_delivery", lambda msg: (msg.author_id, msg.message)),
+}
+
+CASE_FIELDS = ["algorithm", "n", "connectivity", "f", "broadcasters", "seed", "duration"]
+RESULT_FIELDS = CASE_FIELDS + [
+    "status", "wall_time", "broadcasts",
+    "deliveries", "expected_deliveries", "deliveries_per_sec", "latency_p50", "latency_p99", "latency_max",
+    "messages_per_broadcast", "bytes_per_broadcast", "packets_sent", "bytes_sent", "peak_rss_kb", "commit",
+]
+
+
+def circulant_topology(n: int, connectivity: int) -> Dict[int, List[int]]:
+    """
+    Symmetric k-regular topology: every node is linked to its connectivity // 2 nearest nodes on each side of a
+    ring, plus the opposite node when connectivity is odd (n has to be even then).
+    """
+    connectivity = min(connectivity, n - 1)
+    offsets = set(range(1, connectivity // 2 + 1))
+    if connectivity % 2 == 1:
+        if n % 2 == 1:
+            raise ValueError(f"An odd connectivity ({connectivity}) needs an even number of nodes, got {n}")
+        offsets.add(n // 2)
+    return {i: sorted({(i + d) % n for d in offsets} | {(i - d) % n for d in offsets}) for i in range(n)}
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class DeliveryProbe:
+    """
+    Records when each broadcast started and when every node delivered it, on the simulator's virtual clock.
+    """
+
+    def __init__(self):
+        self.started: Dict[object, float] = {}
+        self.deliveries: List[tuple] = [] # (node id, key, time)
+
+    def instrument(self, algorithm, layer: str):
+        """ Subclass of `algorithm` whose on_broadcast and top-layer delivery report to this probe. """
+        delivery_method, key = LAYERS[layer]
+        probe = self
+
+        async def on_broadcast(self, message, *args, **kwargs):
+            probe.started.setdefault(key(message), asyncio.get_running_loop().time())
+            return await super(instrumented, self).on_broadcast(message, *args, **kwargs)
+
+        delivery = getattr(algorithm, delivery_method)
+        if inspect.iscoroutinefunction(delivery):
+            async def deliver(self, message, *args, **kwargs):
+                probe.deliveries.append((self.node_id, key(message), asyncio.get_running_loop().time()))
+                return await delivery(self, message, *args, **kwargs)
+        else:
+            def deliver(self, message, *args, **kwargs):
+                probe.deliveries.append((self.node_id, key(message), asyncio.get_running_loop().time()))
+                return delivery(self, message, *args, **kwargs)
+
+        instrumented = type(algorithm.__name__, (algorithm,), {"on_broadcast": on_broadcast, delivery_method: deliver})
+        return instrumented
+
+
+def benchmark_parameters(algorithm, n: int, f: int, broadcasters: int, messages: int):
+    parameters = default_parameters(algorithm, n)
+    parameters.broadcasters = {node_id: messages for node_id in range(broadcasters)}
+    parameters.malicious_nodes = list(range(n - 1, n - 1 - f, -1))
+    parameters.f = f
+    parameters.retention_interval = None
+    if hasattr(parameters, "causal_broadcast"):
+        parameters.causal_broadcast = {node_id: [] for node_id in range(n)}
+        parameters.delay_config = {"default": 0}
+    return parameters
+
+
+def run_case(case: Dict) -> Dict:
+    """ One benchmark run, meant to be executed in its own process. """
+    from src.implementation import get_algorithm
+
+    probe = DeliveryProbe()
+    algorithm = get_algorithm(case["algorithm"])
+    parameters = benchmark_parameters(algorithm, case["n"], case["f"], case["broadcasters"], case["messages"])
+    topology = circulant_topology(case["n"], case["connectivity"])
+
+    simulation = run_simulation(probe.instrument(algorithm, case["algorithm"]), topology, case["duration"],
+                                parameters=parameters, latency=case["latency"], seed=case["seed"],
+                                output_dir=case["output_dir"])
+    wall_time = simulation.wall_time # the run only, key generation and teardown excluded
+
+    correct = set(topology) - set(parameters.malicious_nodes)
+    latencies = [t - probe.started[key] for node_id, key, t in probe.deliveries
+                 if node_id in correct and key in probe.started]
+    delivered = {key for node_id, key, _ in probe.deliveries if node_id in correct}
+    network = simulation.network
+    return {
+        **{field: case[field] for field in CASE_FIELDS},
+        "status": "ok",
+        "wall_time": round(wall_time, 4),
+        "broadcasts": len(probe.started),
+        "deliveries": len(latencies),
+        "expected_deliveries": len(probe.started) * len(correct),
+        "deliveries_per_sec": round(len(latencies) / wall_time, 2) if wall_time else None,
+        "latency_p50": percentile(latencies, 0.50),
+        "latency_p99": percentile(latencies, 0.99),
+        "latency_max": max(latencies, default=None),
+        "messages_per_broadcast": round(network.packets_sent / len(delivered), 2) if delivered else None,
+        "bytes_per_broadcast": round(network.bytes_sent / len(delivered), 2) if delivered else None,
+        "packets_sent": network.packets_sent,
+        "bytes_sent": network.bytes_sent,
+        # kilobytes on Linux, bytes on macOS
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // (1024 if sys.platform == "darwin" else 1),
+        "commit": case["commit"],
+    }
+
+
+def run_isolated(case: Dict, timeout: Optional[float] = None) -> Dict:
+    """
+    run_case in a fresh process, so ru_maxrss is the peak of that case alone. A case that does not finish within
+    `timeout` seconds is killed and reported with status "timeout".
+    """
+    pool = Pool(1)
+    try:
+        return pool.apply_async(run_case, (case,)).get(timeout)
+    except TimeoutError:
+        return {**{field: case[field] for field in CASE_FIELDS}, "status": "timeout", "commit": case["commit"]}
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def current_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_matrix(algorithms, ns, connectivities, fs, broadcasters, messages: int = 1, duration: float = 30.0,
+               latency: float = 0.01, seed: int = 0, output_dir: str = "output/bench",
+               timeout: Optional[float] = None) -> List[Dict]:
+    commit = current_commit()
+    cases = []
+    for algorithm, n, connectivity, f, b in itertools.product(algorithms, ns, connectivities, fs, broadcasters):
+        if b + f > n or connectivity >= n or (f and 3 * f >= n):
+            continue
+        cases.append({
+            "algorithm": algorithm, "n": n, "connectivity": connectivity, "f": f, "broadcasters": b,
+            "messages": messages, "duration": duration, "latency": latency, "seed": seed, "commit": commit,
+            "output_dir": str(Path(output_dir) / f"{algorithm}-n{n}-k{connectivity}-f{f}-b{b}"),
+        })
+
+    results = []
+    for case in cases:
+        result = run_isolated(case, timeout)
+        label = f"{case['algorithm']} n={case['n']} k={case['connectivity']} f={case['f']} b={case['broadcasters']}"
+        if result["status"] == "timeout":
+            print(f"{label}: did not finish within {timeout}s")
+        else:
+            print(f"{label}: {result['deliveries']}/{result['expected_deliveries']} deliveries, "
+                  f"{result['deliveries_per_sec']}/s, p99 {result['latency_p99']}s")
+        results.append(result)
+    return results
+
+
+def write_results(results: List[Dict], json_file: Optional[str] = None, csv_file: Optional[str] = None) -> None:
+    if json_file:
+        Path(json_file).parent.mkdir(parents=True, exist_ok=True)
+        with open(json_file, "w") as f:
+            json.dump(results, f, indent=2)
+    if csv_file:
+        path = Path(csv_file)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Append, so one file collects the runs of several commits
+        is_new = not path.exists() or path.stat().st_size == 0
+        with open(path, "a", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS)
+            if is_new:
+                writer.writeheader()
+            writer.writerows(results)
+
+
+@click.command()
+@click.option('-a', '--algorithm', 'algorithms', multiple=True, type=click.Choice(list(LAYERS)),
+              default=list(LAYERS))
+@click.option('-n', '--nodes', 'ns', multiple=True, type=int, default=[10])
+@click.option('-k', '--connectivity', 'connectivities', multiple=True, type=int, default=[5])
+@click.option('-f', '--faulty', 'fs', multiple=True, type=int, default=[0])
+@click.option('-b', '--broadcasters', multiple=True, type=int, default=[1])
+@click.option('--messages', type=int, default=1, help='Broadcasts per broadcaster.')
+@click.option('--duration', type=float, default=30.0, help='Virtual seconds per run.')
+@click.option('--latency', type=float, default=0.01, help='Per-packet latency in seconds.')
+@click.option('--seed', type=int, default=0)
+@click.option('--output', type=str, default='output/bench', help='Directory for the node output of every run.')
+@click.option('--timeout', type=float, default=600.0, help='Wall-clock seconds after which a run is killed.')
+@click.option('--json', 'json_file', type=str, default=None)
+@click.option('--csv', 'csv_file', type=str, default=None)
+def main(algorithms, ns, connectivities, fs, broadcasters, messages, duration, latency, seed, output, timeout,
+         json_file, csv_file):
+    results = run_matrix(algorithms, ns, connectivities, fs, broadcasters, messages, duration, latency, seed, output,
+                         timeout)
+    write_results(results, json_file, csv_file)
+    if not json_file and not csv_file:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,10 @@
 from __future__ import annotations
 
 import asyncio
-import random
 import sys
 import typing
 from asyncio import Event
 from pathlib import Path
-from threading import Lock
 from typing import Dict, List, Tuple, Callable
 
 import yaml
@@ -18,6 +16,7 @@ from ipv8.messaging.serialization import Payload
 from ipv8.types import Peer, LazyWrappedHandler, MessageHandlerFunction
 
 from src.system.msg_history import MessageHistory
+from src.system.transport import LoopbackHub, Transport, UdpTransport, make_transport
 
 from src.implementation.node_log import message_logger, OutputMetrics, LOG_LEVEL
 
@@ -38,10 +37,18 @@ AnyPayload = typing.Union[Payload, DataclassPayload]
 class ConnectionMessage:
     node_id: int
     node_state: str
+    retry: bool = False # resent after a timeout, asks the receiver to answer with its own state
 
 
 def message_wrapper(*payloads: type[AnyPayload]) -> Callable[[LazyWrappedHandler], MessageHandlerFunction]:
-    return lazy_wrapper(*payloads)
+    def decorator(func: LazyWrappedHandler) -> MessageHandlerFunction:
+        wrapped = lazy_wrapper(*payloads)(func)
+        # Lets transports that skip the packet format (see src/system/transport.py) call the handler directly
+        wrapped.handler = func
+        wrapped.payload_types = payloads
+        return wrapped
+
+    return decorator
 
 
 class DistributedAlgorithm(Community):
@@ -60,28 +67,67 @@ class DistributedAlgorithm(Community):
         # Register the message handler for messages (with the identifier "1").
         self.nodes: Dict[int, Peer] = {}
         self.node_states: Dict[int, str] = {}
+        # Reverse index of self.nodes, kept in sync by _on_manual_connect
+        self.peer_ids: Dict[Peer, int] = {}
+        self.address_ids: Dict[typing.Any, int] = {}
+        self.neighbour_list: List[Tuple[int, Peer]] = []
+        # msg_id -> (undecorated handler, payload types), for transports that deliver payload objects
+        self.local_handlers: Dict[int, Tuple[Callable, Tuple[type, ...]]] = {}
+        self.transport: Transport = UdpTransport(self)
+
+        # Startup barrier: set once every neighbour did the handshake / announced it is ready
+        self.expected_neighbours: int | None = None
+        self.is_ready = False
+        self.connected_event = asyncio.Event()
+        self.ready_event = asyncio.Event()
+        self.start_delay = 0.0 # seconds between the barrier and on_start
+        self.startup_deadline = 30.0 # seconds to wait for the topology before starting anyway
+        self.startup_backoff = 0.1 # first retry interval, doubled on every timeout
+        self.startup_backoff_max = 2.0
         self.add_message_handler(ConnectionMessage, self._on_manual_connect)
 
     def node_id_from_peer(self, peer: Peer):
-        try:
-            key = next((key for key, p in self.nodes.items() if p == peer))
-            assert key is not None
-        except Exception as e:
-            print(f"Error in node_id_from_peer: {e}")
-            raise e
-
-        return next((key for key, p in self.nodes.items() if p == peer), None)
-
-    async def started(
+        node_id = self.peer_ids.get(peer)
+        if node_id is None:
+            node_id = self.address_ids.get(peer.address)
+        if node_id is None:
+            print(f"Error in node_id_from_peer: unknown peer {peer}")
+            raise KeyError(peer)
+        return node_id
+
+    def neighbours(self) -> List[Tuple[int, Peer]]:
+        """
+        (node id, peer) of every connected node, cached so relay loops do not resolve ids per message.
+        """
+        return self.neighbour_list
+
+    def register_node(self, node_id: int, peer: Peer) -> None:
+        old_peer = self.nodes.get(node_id)
+        if old_peer is not None and old_peer is not peer:
+            self.peer_ids.pop(old_peer, None)
+            for address in old_peer.addresses.values():
+                self.address_ids.pop(address, None)
+
+        self.nodes[node_id] = peer
+        self.peer_ids[peer] = node_id
+        for address in peer.addresses.values():
+            self.address_ids[address] = node_id
+
+        if old_peer is not peer:
+            self.neighbour_list = sorted(self.nodes.items(), key=lambda item: item[0])
+
+    def setup(
             self,
             node_id: int,
-            connections: List[Tuple[int, int]],
             event: Event,
-            use_localhost: bool = True,
             starting_node=0,
             output_file: str = "output/node.out",
             stat_file: str = "output/node.yml",
     ) -> None:
+        """
+        Per-node state that does not depend on the network, split from `started` so that nodes can also be
+        wired up directly (see src/system/simulator.py) instead of through walk_to and the connection handshake.
+        """
         self.event = event
         self.node_id = node_id
         self.starting_node = starting_node
@@ -96,74 +142,134 @@ class DistributedAlgorithm(Community):
 
         self.stat_file = Path(stat_file)
         self.stat_file = self.stat_file.parent / f"{self.stat_file.stem}-{node_id}{self.stat_file.suffix}"
+
+    async def started(
+            self,
+            node_id: int,
+            connections: List[Tuple[int, int]],
+            event: Event,
+            use_localhost: bool = True,
+            starting_node=0,
+            output_file: str = "output/node.out",
+            stat_file: str = "output/node.yml",
+            transport: str = "udp",
+    ) -> None:
+        self.setup(node_id, event, starting_node, output_file, stat_file)
+        self.use_transport(transport)
+
         connections = list(set(connections))
         self.connections = connections
-        self.connectionLock = Lock()
-        self.on_start_delay = random.uniform(2.0, 3.0)  # Seconds
+        self.expected_neighbours = len(connections)
+        self._update_barrier()
         host_network = self._get_lan_address()[0]
         host_network_base = ".".join(host_network.split(".")[:3])
         print(f"[Node {self.node_id}] booting on {host_network_base}.{self.node_id + 10}")
 
-        async def _ensure_nodes_connected() -> None:
-            try:
-                for node_id, conn in self.connections:
-                    ip_address = f"{host_network_base}.{node_id + 10}"
-                    self.node_states[node_id] = "init"
-                    if use_localhost:
-                        ip_address = host_network
-                    ad = (ip_address, conn)
-                    self.walk_to(ad)
-                valid = False
-                conn_nodes = []
-
-                await asyncio.sleep(1)
-                with self.connectionLock:
-                    if len(self.get_peers()) == len(self.connections):
-                        valid = True
-                if not valid:
-                    return
+        addresses = {}
+        for node_id, conn in self.connections:
+            ip_address = host_network if use_localhost else f"{host_network_base}.{node_id + 10}"
+            addresses[node_id] = (ip_address, conn)
 
+        async def _ensure_nodes_connected() -> None:
+            # Introductions trigger the handshake right away (see introduction_*_callback), the loop below only
+            # repeats the walks and handshakes that have not been answered yet.
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + self.startup_deadline
+            backoff = self.startup_backoff
+            while not self.connected_event.is_set():
+                for node_id, address in addresses.items():
+                    if node_id not in self.nodes:
+                        self.walk_to(address)
                 for peer in self.get_peers():
-                    conn_msg = ConnectionMessage(self.node_id, "init")
-                    self.ez_send(peer, conn_msg)
-
-                valid = False
-                with self.connectionLock:
-                    if len(self.nodes) == len(self.connections):
-                        valid = True
-                if not valid:
-                    return
-
-                self.cancel_pending_task("ensure_nodes_connected")
-                self.register_anonymous_task("delayed_start", self.on_start, delay=self.on_start_delay)
-            except Exception as e:
-                print(f"[Node {self.node_id}] Error in ensure_nodes_connected: {e}")
-                # raise e
+                    if peer not in self.peer_ids:
+                        self.ez_send(peer, ConnectionMessage(self.node_id, "init", retry=True))
+
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    print(f"[Node {self.node_id}] Only {len(self.nodes)}/{len(addresses)} neighbours connected "
+                          f"after {self.startup_deadline}s, starting anyway")
+                    break
+                try:
+                    await asyncio.wait_for(self.connected_event.wait(), min(backoff, remaining))
+                except asyncio.TimeoutError:
+                    backoff = min(backoff * 2, self.startup_backoff_max)
+
+            self.register_anonymous_task("delayed_start", self.on_start, delay=self.start_delay)
+
+        self.register_task("ensure_nodes_connected", _ensure_nodes_connected)
+
+    def introduction_request_callback(self, peer: Peer, dist, payload) -> None:
+        self._handshake(peer)
+
+    def introduction_response_callback(self, peer: Peer, dist, payload) -> None:
+        self._handshake(peer)
+
+    def _handshake(self, peer: Peer) -> None:
+        if self.expected_neighbours is not None and peer not in self.peer_ids:
+            self.ez_send(peer, ConnectionMessage(self.node_id, "ready" if self.is_ready else "init"))
+
+    def _update_barrier(self) -> None:
+        if self.expected_neighbours is None or len(self.nodes) >= self.expected_neighbours:
+            self.connected_event.set()
+        if self.connected_event.is_set() and all(state == "ready" for state in self.node_states.values()):
+            self.ready_event.set()
+
+    def announce_ready(self) -> None:
+        """
+        Tell the neighbours this node is ready. Neighbours that connect later learn it from the reply to their
+        handshake, so this only has to be called once.
+        """
+        self.is_ready = True
+        for peer in self.get_peers():
+            self.ez_send(peer, ConnectionMessage(self.node_id, "ready"))
 
-        self.register_task("ensure_nodes_connected", _ensure_nodes_connected, interval=0.5, delay=1)
+    async def wait_until_ready(self) -> bool:
+        """
+        Wait until every neighbour announced it is ready. The ready state is resent to the neighbours that have not
+        answered after an exponentially growing timeout; after `startup_deadline` seconds the wait gives up and
+        returns False.
+        """
+        self._update_barrier()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.startup_deadline
+        backoff = self.startup_backoff
+        while not self.ready_event.is_set():
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                print(f"[Node {self.node_id}] Not all neighbours are ready after {self.startup_deadline}s, "
+                      f"states={self.node_states}")
+                return False
+            try:
+                await asyncio.wait_for(self.ready_event.wait(), min(backoff, remaining))
+            except asyncio.TimeoutError:
+                state = "ready" if self.is_ready else "init"
+                for node_id, peer in self.neighbours():
+                    if self.node_states.get(node_id) != "ready":
+                        self.ez_send(peer, ConnectionMessage(self.node_id, state, retry=True))
+                backoff = min(backoff * 2, self.startup_backoff_max)
+        return True
 
     async def on_start(self):
         # print(f"[Node {self.node_id}] Starting algorithm with peers {[x.address for x in self.get_peers()]} and {self.nodes}")
+        self.announce_ready()
+        print(f"[Node {self.node_id}] is ready")
         if self.node_id == self.starting_node:
-            # Checking if all node states are ready
-            all_ready = all([x == "ready" for x in self.node_states.values()])
-            while not all_ready:
-                await asyncio.sleep(1)
-                all_ready = all([x == "ready" for x in self.node_states.values()])
-            await asyncio.sleep(1)
+            await self.wait_until_ready()
             await self.on_start_as_starter()
 
-        print(f"[Node {self.node_id}] is ready")
-        for peer in self.get_peers():
-            self.ez_send(peer, ConnectionMessage(self.node_id, "ready"))
-
     @message_wrapper(ConnectionMessage)
     def _on_manual_connect(self, peer: Peer, payload: ConnectionMessage):
         # print(f"[Node {self.node_id}] Got connection message from {payload.node_id} with state {payload.node_state} len(self.nodes)={len(self.nodes)} =?= {len(self.connections)}")
-        self.nodes[payload.node_id] = peer
-        peer_port = peer.address[1]
+        is_new = payload.node_id not in self.nodes
+        changed = self.node_states.get(payload.node_id) != payload.node_state
+        self.register_node(payload.node_id, peer)
         self.node_states[payload.node_id] = payload.node_state
-        self.nodes[payload.node_id] = peer
+        self._update_barrier()
+
+        # Answer with our own state so that a neighbour which came up (or got ready) after us does not have to wait
+        # for a retry. States only go init -> ready, so two nodes answer each other a bounded number of times.
+        if is_new or changed or payload.retry:
+            self.ez_send(peer, ConnectionMessage(self.node_id, "ready" if self.is_ready else "init"))
 
     async def on_start_as_starter(self):
         pass
@@ -174,20 +280,41 @@ class DistributedAlgorithm(Community):
             print(f"[Node {self.node_id}] Stopping algorithm")
             self.save_algorithm_output()
             self.save_node_stats()
+            self.save_latency_histograms()
+            self.msg_log.close()
             self.event.set()
 
         self.register_anonymous_task("delayed_stop", delayed_stop, delay=delay)
 
-    def ez_send(self, peer: Peer, *payloads: AnyPayload, **kwargs) -> None:
+    def peer_address(self, peer: Peer):
         addr = peer.addresses.get(UDPv4LANAddress, None)
         if addr is None:
             addr = peer.addresses.get(UDPv4Address, None)
         assert addr is not None
-        self._message_history.add_message(*payloads, destination=addr)
-        self._ez_senda(addr, *payloads, **kwargs)
+        return addr
+
+    def use_transport(self, name: str, hub: LoopbackHub | None = None) -> None:
+        """
+        Switch how payloads are sent, see src/system/transport.py for the available transports.
+        """
+        self.transport = make_transport(name, self, hub)
+
+    def ez_send(self, peer: Peer, *payloads: AnyPayload, **kwargs) -> None:
+        self.transport.send((peer,), *payloads, **kwargs)
+
+    def multicast(self, peers: typing.Iterable[Peer], *payloads: AnyPayload, **kwargs) -> None:
+        """
+        Send the same payload to several peers: over UDP it is serialized and signed once and the resulting
+        packet is written to every destination.
+        """
+        self.transport.send(peers, *payloads, **kwargs)
 
     def add_message_handler(self, msg_num: int | type[AnyPayload], callback: MessageHandlerFunction) -> None:
         super().add_message_handler(msg_num, callback)
+        payload_types = getattr(callback, "payload_types", None)
+        if payload_types is not None:
+            msg_id = msg_num if isinstance(msg_num, int) else msg_num.msg_id
+            self.local_handlers[msg_id] = (callback.handler.__get__(self), payload_types)
 
     def on_packet(self, packet: Tuple[Tuple[str | int] | bytes], warn_unknown: bool = True) -> None:
         # import time
@@ -210,8 +337,22 @@ class DistributedAlgorithm(Community):
         p = Path(self.stat_file)
         p.parent.mkdir(parents=True, exist_ok=True)
         stats = {"messages_received": len(self._message_history), "bytes_sent": self._message_history.bytes_sent()}
+        if self._message_history.track_aggregates:
+            stats.update(self._message_history.aggregates())
         # Save stats object as yaml
         with open(p, "w") as f:
             yaml.dump(stats, f)
 
         print(f"[Node {self.node_id}] Node stats saved to {p} in {p.resolve()}")
+
+    def save_latency_histograms(self):
+        """
+        Delivery latency histograms (ms) per layer and per phase, next to the node stats.
+        """
+        histograms = self.msg_log.latency_summary()
+        if not histograms:
+            return
+        p = self.stat_file.parent / f"{self.stat_file.stem}-latency{self.stat_file.suffix}"
+        p.parent.mkdir(parents=True, exist_ok=True)
+        with open(p, "w") as f:
+            yaml.dump(histograms, f, sort_keys=False)
@@ -0,0 +1,56 @@
+import random
+from typing import Dict, Hashable, Optional, Tuple, Union
+
+# A delay spec is either a constant number of seconds or a tuple naming a distribution:
+#   ("const", d) | ("uniform", low, high) | ("choice", [d1, d2, ...]) | ("exp", mean) | ("normal", mu, sigma)
+DelaySpec = Union[float, int, Tuple]
+
+
+class DelayInjector:
+    """
+    Seeded source of artificial delays, used to inject latency/jitter without blocking the event loop.
+
+    The delay of an event is the delay of its message type plus the delay of its link (a (from, to) tuple).
+    `default` is only used when neither has a rule. Callers schedule the delayed work themselves, e.g. with
+    `register_anonymous_task(..., delay=injector.delay_for(...))`.
+    """
+
+    def __init__(self, default: DelaySpec = 0, per_type: Optional[Dict[Hashable, DelaySpec]] = None,
+                 per_link: Optional[Dict[Tuple[int, int], DelaySpec]] = None, seed: Optional[int] = None):
+        self.default = default
+        self.per_type = per_type or {}
+        self.per_link = per_link or {}
+        # unseeded injectors draw their seed from the global RNG, so seeding `random` makes a whole run reproducible
+        self.rng = random.Random(seed if seed is not None else random.getrandbits(64))
+
+    def delay_for(self, msg_type: Hashable = None, link: Tuple[int, int] = None) -> float:
+        type_spec = self.per_type.get(msg_type)
+        link_spec = self.per_link.get(link)
+        if type_spec is None and link_spec is None:
+            return self.sample(self.default)
+        return self.sample(type_spec) + self.sample(link_spec)
+
+    def sample(self, spec: DelaySpec) -> float:
+        if spec is None:
+            return 0.0
+        if isinstance(spec, (int, float)):
+            return float(spec)
+
+        kind, *args = spec
+        if kind == "const":
+            value = args[0]
+        elif kind == "uniform":
+            value = self.rng.uniform(args[0], args[1])
+        elif kind == "choice":
+            value = self.rng.choice(args[0])
+        elif kind == "exp":
+            value = self.rng.expovariate(1.0 / args[0]) if args[0] > 0 else 0.0
+        elif kind == "normal":
+            value = self.rng.gauss(args[0], args[1])
+        else:
+            raise ValueError(f"Unknown delay distribution: {kind}")
+        return max(0.0, float(value))
+
+    @classmethod
+    def from_config(cls, config: Optional[Dict]) -> "DelayInjector":
+        return cls(**(config or {}))
@@ -1,4 +1,5 @@
 import sys
+from collections import deque
 def sizeof(obj):
     size = sys.getsizeof(obj)
     if isinstance(obj, dict): return size + sum(map(sizeof, obj.keys())) + sum(map(sizeof, obj.values()))
@@ -7,30 +8,58 @@ def sizeof(obj):
 
 
 class MessageHistory:
-    def __init__(self):
-        self.__history = []
+    """
+    Counts the messages and bytes sent by a node.
+
+    By default only counters are kept. `history_size` keeps the last raw (destination, message) pairs in a
+    ring buffer (None keeps everything, as before), `track_aggregates` additionally keeps count/bytes per
+    payload type and per destination. Byte counts are the size of the packet that was actually sent when
+    the caller passes it, the recursive `sizeof` estimate is only used as a fallback.
+    """
+
+    def __init__(self, history_size: int = 0, track_aggregates: bool = False):
+        self.__history = deque(maxlen=history_size)
         self.__num_received = 0
         self.__num_sent = 0
         self.__bytes_sent = 0
         self.__bytes_received = 0
+        self.track_aggregates = track_aggregates
+        self.per_type: dict = {}
+        self.per_destination: dict = {}
 
-    def add_message(self, message, destination):
-        self.__history.append((destination, message))
+    def add_message(self, message, destination, size: int = None):
+        if self.__history.maxlen != 0:
+            self.__history.append((destination, message))
         self.__num_sent += 1
-        # print(f"Message sent to {destination}: {sizeof(message)}")
-        self.__bytes_sent += sizeof(message)
-    
+        if size is None:
+            size = sizeof(message)
+        # print(f"Message sent to {destination}: {size}")
+        self.__bytes_sent += size
+
+        if self.track_aggregates:
+            for key, aggregate in ((type(message).__name__, self.per_type), (destination, self.per_destination)):
+                counts = aggregate.setdefault(key, [0, 0])
+                counts[0] += 1
+                counts[1] += size
+
     def receieve_message(self):
         self.__num_received += 1
 
     def get_history(self):
-        return self.__history
+        return list(self.__history)
 
     def clear_history(self):
-        self.__history = []
-    
+        self.__history.clear()
+
     def __len__(self):
-        return len(self.__history)
-    
+        return self.__num_sent
+
     def bytes_sent(self):
-        return self.__bytes_sent
\ No newline at end of file
+        return self.__bytes_sent
+
+    def aggregates(self):
+        return {
+            "per_type": {key: {"messages": c, "bytes": b} for key, (c, b) in self.per_type.items()},
+            "per_destination": {f"{key[0]}:{key[1]}": {"messages": c, "bytes": b}
+                                for key, (c, b) in self.per_destination.items()},
+        }
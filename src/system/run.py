@@ -1,12 +1,18 @@
 import argparse
+import asyncio
 import importlib
+import os
+from multiprocessing import Pool
 from pathlib import Path
+from typing import Dict, List
 import yaml
 from asyncio import run
 from ipv8.configuration import ConfigBuilder, Strategy, WalkerDefinition, default_bootstrap_defs, BootstrapperDefinition, Bootstrapper
 from ipv8.util import create_event_with_signals
 from ipv8_service import IPv8
 
+from src.system.transport import TRANSPORTS
+
 def load_algorithm(alg_name: str, location = 'cs4545'):
     try:
         mod = importlib.import_module(f'{location}.implementation')
@@ -16,8 +22,9 @@ def load_algorithm(alg_name: str, location = 'cs4545'):
         raise e
 
 
-async def start_communities(node_id, connections, algorithm, use_localhost=True) -> None:
-    event = create_event_with_signals()
+async def start_communities(node_id, connections, algorithm, use_localhost=True, transport="udp", event=None) -> None:
+    if event is None:
+        event = create_event_with_signals()
     base_port = 9090
     connections_updated = [(x, base_port + x) for x in connections]
     node_port = base_port + node_id
@@ -37,7 +44,8 @@ async def start_communities(node_id, connections, algorithm, use_localhost=True)
         [],
         [],
         {},
-        [("started", node_id, connections_updated, event, use_localhost)],
+        [("started", node_id, connections_updated, event, use_localhost, 0, "output/node.out", "output/node.yml",
+          transport)],
     )
     ipv8_instance = IPv8(
         builder.finalize(), extra_communities={"DA_Alg_Test": algorithm}
@@ -47,24 +55,82 @@ async def start_communities(node_id, connections, algorithm, use_localhost=True)
     await ipv8_instance.stop()
 
 
+def parse_node_ids(spec: str, topology: Dict[int, List[int]]) -> List[int]:
+    """
+    "3" -> [3], "all" -> every node in the topology, "0-9" -> range (inclusive), "0,2,5-7" -> combinations.
+    """
+    if spec == "all":
+        return sorted(topology)
+    node_ids = []
+    for part in spec.split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            node_ids.extend(range(int(first), int(last) + 1))
+        else:
+            node_ids.append(int(part))
+    return node_ids
+
+
+async def start_nodes(node_ids, topology, algorithm, use_localhost=True, transport="udp") -> None:
+    """
+    Runs several nodes, each with its own IPv8 instance and port, on the event loop of this process.
+    The process keeps running until every node has stopped.
+    """
+    stop_all = create_event_with_signals()
+    events = {node_id: asyncio.Event() for node_id in node_ids}
+
+    async def stop_on_signal():
+        await stop_all.wait()
+        for event in events.values():
+            event.set()
+
+    signal_task = asyncio.ensure_future(stop_on_signal())
+    await asyncio.gather(*(start_communities(node_id, topology[node_id], algorithm, use_localhost, transport,
+                                             events[node_id])
+                           for node_id in node_ids))
+    signal_task.cancel()
+
+
+def run_shard(shard_index, node_ids, topology, alg_name, location, use_localhost, transport) -> None:
+    # Pin the shard to a core where the platform allows it
+    if hasattr(os, "sched_setaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+        os.sched_setaffinity(0, {cores[shard_index % len(cores)]})
+    alg = load_algorithm(alg_name, location=location)
+    run(start_nodes(node_ids, topology, alg, use_localhost, transport))
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         prog="Distributed Algorithms",
         description="Code to execute distributed algorithms.",
         epilog="written by Bart Cox (2023)",
     )
-    parser.add_argument("node_id", type=int)
+    parser.add_argument("node_id", type=str, help='a node id, or several to run in this process: "all", "0-9", "0,2,5"')
     parser.add_argument("topology", type=str, nargs="?", default="topologies/default.yaml")
     parser.add_argument("algorithm", type=str, nargs="?", default='echo')
     parser.add_argument("-location", type=str, default='cs4545')
     parser.add_argument("-docker", action='store_true')
+    parser.add_argument("-transport", type=str, choices=TRANSPORTS, default="udp",
+                        help="loopback transports only reach nodes started in the same process, others get UDP")
+    parser.add_argument("-processes", type=int, default=1,
+                        help="number of processes to shard the nodes over, one per core; 0 uses every core")
     args = parser.parse_args()
-    node_id = args.node_id
 
-    # alg = get_algorithm(args.algorithm)
-    alg = load_algorithm(args.algorithm, location=args.location)
     with open(args.topology, "r") as f:
         topology = yaml.safe_load(f)
-        connections = topology[node_id]
+    node_ids = parse_node_ids(args.node_id, topology)
 
-        run(start_communities(node_id, connections, alg, not args.docker))
+    processes = min(args.processes or os.cpu_count() or 1, len(node_ids))
+    if len(node_ids) == 1:
+        # alg = get_algorithm(args.algorithm)
+        alg = load_algorithm(args.algorithm, location=args.location)
+        run(start_communities(node_ids[0], topology[node_ids[0]], alg, not args.docker, args.transport))
+    elif processes <= 1:
+        alg = load_algorithm(args.algorithm, location=args.location)
+        run(start_nodes(node_ids, topology, alg, not args.docker, args.transport))
+    else:
+        shards = [(i, node_ids[i::processes], topology, args.algorithm, args.location, not args.docker, args.transport)
+                  for i in range(processes)]
+        with Pool(processes) as pool:
+            pool.starmap(run_shard, shards)
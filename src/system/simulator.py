@@ -0,0 +1,295 @@
+"""
+Deterministic in-process simulation of a whole topology.
+
+All nodes run as ordinary Community instances inside one process, on an event loop whose clock is virtual: when
+nothing is runnable the loop jumps straight to the next timer instead of sleeping. Packets travel over a simulated
+network with configurable latency/jitter (a DelaySpec, see src/system/delay.py) and loss.
+
+    python -m src.system.simulator rco topologies/dolev.yaml --duration 30 --latency 0.01 --seed 1
+
+Runs are reproducible for a given seed: node keys are drawn from the seed, message ids are derived from per-node
+counters and BLAKE2b digests, not from the per-process salted hash(), and every node clock (metrics, state
+retention) is the virtual one.
+"""
+import asyncio
+import copy
+import inspect
+import random
+import selectors
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import click
+import yaml
+from ipv8.community import CommunitySettings
+from ipv8.keyvault.crypto import default_eccrypto
+from ipv8.messaging.interfaces.endpoint import Endpoint
+from ipv8.messaging.interfaces.udp.endpoint import UDPv4Address
+from ipv8.peer import Peer
+from ipv8.peerdiscovery.network import Network
+
+from src.implementation.retention import StateRetention
+from src.system.delay import DelayInjector, DelaySpec
+
+SIM_EPOCH = datetime(2000, 1, 1) # wall-clock time that virtual time 0 maps to in the logs and metrics
+
+
+class _VirtualSelector(selectors.BaseSelector):
+    """
+    Wraps a real selector but never blocks on a timeout: the wait is added to the loop's virtual clock.
+    """
+
+    def __init__(self, loop: "VirtualClockLoop"):
+        self._loop = loop
+        self._selector = selectors.DefaultSelector()
+
+    def register(self, fileobj, events, data=None):
+        return self._selector.register(fileobj, events, data)
+
+    def unregister(self, fileobj):
+        return self._selector.unregister(fileobj)
+
+    def modify(self, fileobj, events, data=None):
+        return self._selector.modify(fileobj, events, data)
+
+    def select(self, timeout=None):
+        if timeout is None: # nothing scheduled, only another thread can wake us up
+            return self._selector.select(None)
+        events = self._selector.select(0)
+        if not events and timeout > 0:
+            self._loop.advance(timeout)
+        return events
+
+    def close(self):
+        self._selector.close()
+
+    def get_map(self):
+        return self._selector.get_map()
+
+
+class VirtualClockLoop(asyncio.SelectorEventLoop):
+    """
+    Event loop whose time() is virtual, so asyncio.sleep / call_later / ipv8 task intervals cost no real time.
+    """
+
+    def __init__(self):
+        self._virtual_time = 0.0
+        super().__init__(_VirtualSelector(self))
+
+    def time(self) -> float:
+        return self._virtual_time
+
+    def advance(self, seconds: float) -> None:
+        self._virtual_time += seconds
+
+
+class SimulatedNetwork:
+    """
+    Routes packets between SimulatedEndpoints. Each packet is delayed by `delays.delay_for(msg_type, (src, dst))`,
+    where msg_type is the ipv8 message id and src/dst are node ids, and is dropped with probability `loss`.
+    """
+
+    def __init__(self, delays: DelayInjector, loss: float = 0.0, seed: Optional[int] = None):
+        self.delays = delays
+        self.loss = loss
+        self.rng = random.Random(seed)
+        self.endpoints: Dict[UDPv4Address, "SimulatedEndpoint"] = {}
+        self.packets_sent = 0
+        self.packets_dropped = 0
+        self.bytes_sent = 0
+
+    @staticmethod
+    def node_address(node_id: int) -> UDPv4Address:
+        host = node_id + 10
+        return UDPv4Address(f"10.{host >> 16 & 255}.{host >> 8 & 255}.{host & 255}", 9090 + node_id)
+
+    def endpoint(self, node_id: int) -> "SimulatedEndpoint":
+        endpoint = SimulatedEndpoint(self, node_id, self.node_address(node_id))
+        self.endpoints[endpoint.wan_address] = endpoint
+        return endpoint
+
+    def route(self, source: "SimulatedEndpoint", address, packet: bytes) -> None:
+        destination = self.endpoints.get(address)
+        self.packets_sent += 1
+        self.bytes_sent += len(packet)
+        if destination is None or (self.loss and self.rng.random() < self.loss):
+            self.packets_dropped += 1
+            return
+
+        msg_type = packet[22] if len(packet) > 22 else None
+        delay = self.delays.delay_for(msg_type, (source.node_id, destination.node_id))
+        loop = asyncio.get_running_loop()
+        if delay > 0:
+            loop.call_later(delay, destination.notify_listeners, (source.wan_address, packet))
+        else:
+            loop.call_soon(destination.notify_listeners, (source.wan_address, packet))
+
+
+class SimulatedEndpoint(Endpoint):
+
+    def __init__(self, network: SimulatedNetwork, node_id: int, address: UDPv4Address):
+        super().__init__()
+        self.network = network
+        self.node_id = node_id
+        self.lan_address = self.wan_address = address
+        self._open = False
+
+    def assert_open(self) -> None:
+        assert self._open
+
+    def is_open(self) -> bool:
+        return self._open
+
+    def get_address(self):
+        return self.wan_address
+
+    def send(self, socket_address, packet: bytes) -> None:
+        if self._open:
+            self.network.route(self, socket_address, packet)
+
+    async def open(self) -> bool:
+        self._open = True
+        return True
+
+    def close(self, timeout: float = 0.0) -> None:
+        self._open = False
+
+    def reset_byte_counters(self) -> None:
+        pass
+
+
+def load_topology(topology_file) -> Dict[int, List[int]]:
+    with open(topology_file, "r") as f:
+        return {int(node_id): list(connections) for node_id, connections in yaml.safe_load(f).items()}
+
+
+def default_parameters(algorithm, n: int):
+    """ A copy of the algorithm's default config with N set to the size of the topology, None if it takes none. """
+    default = inspect.signature(algorithm.__init__).parameters.get("parameters")
+    if default is None or default.default is inspect.Parameter.empty:
+        return None
+    parameters = copy.deepcopy(default.default)
+    if hasattr(parameters, "N"):
+        parameters.N = n
+    return parameters
+
+
+class Simulation:
+    """
+    N instances of `algorithm` wired according to `topology` ({node id: [neighbour ids]}) over a SimulatedNetwork.
+    Has to be run on a VirtualClockLoop, `run_simulation` takes care of that.
+    """
+
+    def __init__(self, algorithm, topology: Dict[int, List[int]], parameters=None, latency: DelaySpec = 0.01,
+                 per_link: Optional[Dict] = None, per_type: Optional[Dict] = None, loss: float = 0.0,
+                 seed: int = 0, output_dir: str = "output/sim"):
+        self.algorithm = algorithm
+        self.topology = topology
+        self.parameters = parameters if parameters is not None else default_parameters(algorithm, len(topology))
+        self.seed = seed
+        self.output_dir = Path(output_dir)
+        self.network = SimulatedNetwork(DelayInjector(latency, per_type, per_link, seed), loss, seed)
+        self.nodes: Dict[int, "DistributedAlgorithm"] = {}
+        self.wall_time: Optional[float] = None # wall-clock seconds from start to stop, without build() and unload
+
+    def now(self) -> datetime:
+        return SIM_EPOCH + timedelta(seconds=asyncio.get_running_loop().time())
+
+    def build(self) -> None:
+        random.seed(self.seed)
+        keys = random.Random(self.seed)
+        clock = asyncio.get_running_loop().time
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        for node_id in sorted(self.topology):
+            endpoint = self.network.endpoint(node_id)
+            endpoint._open = True
+            # keys decide the peer mids and so the order of everything keyed by Peer, they have to follow the seed
+            key = default_eccrypto.key_from_private_bin(b"LibNaCLSK:" + keys.randbytes(64))
+            settings = CommunitySettings(my_peer=Peer(key), endpoint=endpoint, network=Network())
+            node = self.algorithm(settings, self.parameters) if self.parameters is not None else self.algorithm(settings)
+            node.setup(node_id, asyncio.Event(), output_file=str(self.output_dir / "node.out"),
+                       stat_file=str(self.output_dir / "node.yml"))
+            node.msg_log.now = self.now
+            node.msg_log.clock = clock
+            for retention in vars(node).values():
+                if isinstance(retention, StateRetention):
+                    retention.clock = clock
+            self.nodes[node_id] = node
+
+        for node_id, node in self.nodes.items():
+            for neighbour_id in self.topology[node_id]:
+                neighbour = self.nodes[neighbour_id]
+                peer = Peer(neighbour.my_peer.public_key.key_to_bin(), neighbour.endpoint.wan_address)
+                node.network.add_verified_peer(peer)
+                node.network.discover_services(peer, [node.community_id])
+                node.register_node(neighbour_id, peer)
+                node.node_states[neighbour_id] = "init"
+
+    async def run(self, duration: float) -> Dict[int, "DistributedAlgorithm"]:
+        """ Start every node, let them run for `duration` virtual seconds, then stop them and save their output. """
+        self.build()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + duration
+        start = time.perf_counter()
+
+        await asyncio.gather(*(node.on_start() for node in self.nodes.values()))
+        await asyncio.sleep(max(0.0, deadline - loop.time()))
+
+        for node in self.nodes.values():
+            node.stop()
+        await asyncio.gather(*(node.event.wait() for node in self.nodes.values()))
+        self.wall_time = time.perf_counter() - start
+        for node in self.nodes.values():
+            await node.unload()
+        return self.nodes
+
+    def summary(self) -> Dict:
+        nodes = {}
+        for node_id, node in self.nodes.items():
+            history = node._message_history
+            metrics = node.msg_log.log_metrics
+            nodes[node_id] = {"delivered": metrics.delivered_msg_cnt, "messages_sent": len(history),
+                              "bytes_sent": history.bytes_sent()}
+        return {
+            "algorithm": self.algorithm.__name__,
+            "seed": self.seed,
+            "packets_sent": self.network.packets_sent,
+            "packets_dropped": self.network.packets_dropped,
+            "bytes_sent": self.network.bytes_sent,
+            "nodes": nodes,
+        }
+
+
+def run_simulation(algorithm, topology: Dict[int, List[int]], duration: float = 30.0, **kwargs) -> Simulation:
+    """ Run a Simulation to completion on a fresh VirtualClockLoop and return it. """
+    simulation = Simulation(algorithm, topology, **kwargs)
+    loop = VirtualClockLoop()
+    try:
+        loop.run_until_complete(simulation.run(duration))
+    finally:
+        loop.close()
+    return simulation
+
+
+@click.command()
+@click.argument('algorithm', type=str, default='rco')
+@click.argument('topology_file', type=str, default='topologies/dolev.yaml')
+@click.option('--duration', type=float, default=30.0, help='Virtual seconds to run before stopping all nodes.')
+@click.option('--latency', type=float, default=0.01, help='Per-packet latency in seconds.')
+@click.option('--jitter', type=float, default=0.0, help='Extra uniformly distributed latency in seconds.')
+@click.option('--loss', type=float, default=0.0, help='Probability that a packet is dropped.')
+@click.option('--seed', type=int, default=0)
+@click.option('--output', type=str, default='output/sim')
+def main(algorithm, topology_file, duration, latency, jitter, loss, seed, output):
+    from src.implementation import get_algorithm
+
+    latency_spec = ("uniform", latency, latency + jitter) if jitter else latency
+    simulation = run_simulation(get_algorithm(algorithm), load_topology(topology_file), duration,
+                                latency=latency_spec, loss=loss, seed=seed, output_dir=output)
+    print(yaml.safe_dump(simulation.summary(), sort_keys=False))
+
+
+if __name__ == "__main__":
+    main()
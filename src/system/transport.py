@@ -0,0 +1,136 @@
+"""
+How a DistributedAlgorithm puts its payloads on the wire.
+
+UdpTransport is the normal path: payloads are packed and signed once (ezr_pack) and sent through the ipv8 endpoint.
+LoopbackTransport connects nodes that live in the same process through a LoopbackHub: payloads go through
+asyncio queues and are handed to the undecorated message handlers, so neither sockets nor signatures are involved.
+"""
+import asyncio
+import copy
+from abc import ABC, abstractmethod
+from inspect import iscoroutine
+from typing import Dict, Iterable, Optional
+
+from ipv8.peer import Peer
+
+
+class Transport(ABC):
+
+    def __init__(self, node: "DistributedAlgorithm"):
+        self.node = node
+
+    @abstractmethod
+    def send(self, peers: Iterable[Peer], *payloads, **kwargs) -> None:
+        """ Send `payloads` to every peer in `peers`, kwargs are passed on to ezr_pack. """
+
+
+class UdpTransport(Transport):
+
+    def send(self, peers: Iterable[Peer], *payloads, **kwargs) -> None:
+        node = self.node
+        addresses = [node.peer_address(peer) for peer in peers]
+        if not addresses:
+            return
+        packet = node.ezr_pack(payloads[-1].msg_id, *payloads, **kwargs)
+        for addr in addresses:
+            node._message_history.add_message(*payloads, destination=addr, size=len(packet))
+            node.endpoint.send(addr, packet)
+
+
+class LoopbackHub:
+    """
+    Registry of the in-process nodes, by peer mid: the socket address a node binds to is not necessarily the
+    address its neighbours know it under.
+    """
+
+    def __init__(self):
+        self.transports: Dict[bytes, "LoopbackTransport"] = {}
+
+    def register(self, mid: bytes, transport: "LoopbackTransport") -> None:
+        self.transports[mid] = transport
+
+    def get(self, mid: bytes) -> Optional["LoopbackTransport"]:
+        return self.transports.get(mid)
+
+
+DEFAULT_HUB = LoopbackHub() # shared by every node started in this process
+
+
+class LoopbackTransport(Transport):
+    """
+    In-memory transport between nodes registered on the same LoopbackHub. Peers that are not on the hub (e.g. nodes
+    in another process) are reached over UDP.
+
+    With serialize=False payloads are deep-copied per destination (handlers mutate what they receive) and no bytes
+    are produced, message sizes then fall back to the MessageHistory estimate. With serialize=True the payloads are
+    packed once with the ipv8 serializer and unpacked by every receiver, without the authentication header and
+    signature, so the serialization cost stays in the measurement.
+    """
+
+    def __init__(self, node: "DistributedAlgorithm", hub: LoopbackHub, serialize: bool = False):
+        super().__init__(node)
+        self.hub = hub
+        self.serialize = serialize
+        self.fallback = UdpTransport(node)
+        self.inbox: asyncio.Queue = asyncio.Queue()
+        hub.register(node.my_peer.mid, self)
+        node.register_task("loopback_receiver", self._receive)
+
+    def send(self, peers: Iterable[Peer], *payloads, **kwargs) -> None:
+        node = self.node
+        data = node.serializer.pack_serializable_list(payloads) if self.serialize else None
+        remote = []
+        for peer in peers:
+            target = self.hub.get(peer.mid)
+            if target is None:
+                remote.append(peer)
+                continue
+            addr = node.peer_address(peer)
+            node._message_history.add_message(*payloads, destination=addr, size=len(data) if data is not None else None)
+            message = data if data is not None else [copy.deepcopy(payload) for payload in payloads]
+            target.inbox.put_nowait((node.my_peer, payloads[-1].msg_id, message))
+        if remote:
+            self.fallback.send(remote, *payloads, **kwargs)
+
+    async def _receive(self) -> None:
+        while True:
+            source, msg_id, message = await self.inbox.get()
+            self.dispatch(source, msg_id, message)
+
+    def dispatch(self, source: Peer, msg_id: int, message) -> None:
+        node = self.node
+        local_handler = node.local_handlers.get(msg_id)
+        if local_handler is None:
+            return
+        handler, payload_types = local_handler
+        if self.serialize:
+            payloads = node.serializer.unpack_serializable_list(payload_types, message)[:len(payload_types)]
+        else:
+            payloads = message
+
+        # Peers compare by public key, so this finds the receiver's own Peer object for the sender if it has one
+        peer = node.nodes.get(node.peer_ids.get(source))
+        if peer is None:
+            peer = node.network.get_verified_by_public_key_bin(source.public_key.key_to_bin())
+        if peer is None:
+            return
+
+        try:
+            result = handler(peer, *payloads)
+            if iscoroutine(result):
+                # no ignore=, so the task manager logs a failing handler the same way it does for UDP packets
+                node.register_anonymous_task("on_loopback_packet", asyncio.ensure_future(result))
+        except Exception:
+            # reported like ipv8 reports a failing packet handler, and the receiver task keeps running
+            node.logger.exception("Exception occurred while handling loopback message %d", msg_id)
+
+
+TRANSPORTS = ("udp", "loopback", "loopback-serialize")
+
+
+def make_transport(name: str, node: "DistributedAlgorithm", hub: Optional[LoopbackHub] = None) -> Transport:
+    if name == "udp":
+        return UdpTransport(node)
+    if name in ("loopback", "loopback-serialize"):
+        return LoopbackTransport(node, hub if hub is not None else DEFAULT_HUB, serialize=name == "loopback-serialize")
+    raise ValueError(f"Unknown transport: {name}")
@@ -0,0 +1,29 @@
+from src.implementation.dolev_paths import MessagePaths
+
+
+def test_paths_through_the_same_relay_are_not_disjoint():
+    # both paths go through node 5, so with f=1 they must not count as 2 disjoint routes
+    paths = MessagePaths()
+    paths.add((0, 3, 5))
+    paths.add((0, 5, 3))
+    assert not paths.has_disjoint_paths(2)
+    assert paths.has_disjoint_paths(1)
+
+
+def test_packing_is_found_after_a_failed_search():
+    paths = MessagePaths()
+    paths.add((0, 1, 2))
+    paths.add((0, 1))
+    assert not paths.has_disjoint_paths(2)
+    paths.add((0, 2))
+    assert paths.has_disjoint_paths(2)
+    assert sorted(paths.disjoint_paths()) == [[1], [2]]
+
+
+def test_removed_relay_breaks_the_packing():
+    paths = MessagePaths()
+    paths.add((0,))
+    paths.add((0, 4))
+    assert paths.has_disjoint_paths(2)
+    paths.discard_through(4)
+    assert not paths.has_disjoint_paths(2)